@@ -0,0 +1,307 @@
+"""
+Offline benchmarks of the hot paths, against local JSON-RPC and GraphQL stubs.
+
+Every benchmark runs in its own process, from the directory of the code it
+measures, so modules with the same name in different directories do not clash and
+peak RSS is per benchmark. Wall time is the median of `--repeat` runs of the
+timed part, setup such as starting stubs and loading data is excluded, and its
+spread the median absolute deviation of the runs over the median.
+
+A benchmark regresses when it is slower than the baseline by more than
+`--tolerance`, or by more than `--noise` times the spreads of both measurements
+when those are wider, so a noisy benchmark does not fail on a single slow run.
+
+    python benchmarks/bench.py                    # run all, compare with baseline.json
+    python benchmarks/bench.py fetch_safes rai_process
+    python benchmarks/bench.py --save             # write the results as the new baseline
+"""
+import os
+import sys
+import json
+import time
+import statistics
+import argparse
+import resource
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# name -> (directory, description), the benchmark itself is `bench_<name>` below
+BENCHMARKS = {
+    'rai_process': ('controller', 'Rai.process of 50 scenarios over the historical market prices of the scaled calculator'),
+    'rai_batch': ('controller', 'RaiBatch.run of 1000 scenarios over the same prices'),
+    'fetch_rp_web3': ('rai_usd', 'fetch(fetch_rp) with web3 workers, one eth_call per block'),
+    'fetch_link_batch': ('rai_usd', 'fetch(fetch_link_mp) with JSON-RPC batches of 100 blocks'),
+    'fetch_rp_async': ('rai_usd', "fetch(fetch_rp, engine='async')"),
+    'fetch_safes': ('liquidation_ratio', 'fetch_safes keyset pagination of 20k SAFEs'),
+    'shock_cratios': ('liquidation_ratio', 'update_cratios + liquidate_critical over 61 shocks'),
+    'shock_run': ('liquidation_ratio', 'run() of 61 shocks at once x 5 liquidation ratios'),
+    'create_prod_twap': ('twap', 'create_prod_twap(16, 4) on the as-of aligned RAI/ETH and ETH/USD feeds'),
+}
+
+def notebook_code(path, markers):
+    """
+    Source of the code cells of notebook `path` containing any of `markers`, in order
+    """
+    with open(path) as fp:
+        cells = json.load(fp)['cells']
+    sources = [''.join(c['source']) for c in cells if c['cell_type'] == 'code']
+    return '\n'.join(s for s in sources if any(m in s for m in markers))
+
+def hourly_freq(source):
+    # the notebooks spell hours 'H', which pandas 2.2 deprecates in favour of 'h'
+    import pandas as pd
+    major, minor = map(int, pd.__version__.split('.')[:2])
+    return source.replace("'H'", "'h'") if (major, minor) >= (2, 2) else source
+
+def bench_rai_process():
+    import numpy as np
+    import pandas as pd
+    from rai import Rai
+    from monitoring import load
+
+    df = load()
+    df = df[df['blockNumber'].astype(int) >= 15046690].reset_index(drop=True)
+    market_prices = [int(x) / 1e27 for x in df['marketPrice']]
+    timestamps = df['ts'].astype(int).tolist()
+    first = df.iloc[0]
+    kp = float(first['sg']) * np.geomspace(0.1, 10, 50)
+
+    def run():
+        for x in kp:
+            rai = Rai(int(first['redemptionPrice']) / 1e27, int(first['redemptionRate']), timestamps[0],
+                      x, float(first['ag']), int(first['pscl']))
+            for mp, ts in zip(market_prices[1:], timestamps[1:]):
+                rai.process(mp, ts)
+        return len(kp) * (len(timestamps) - 1)
+
+    return run
+
+def bench_rai_batch():
+    import numpy as np
+    import pandas as pd
+    from rai_batch import RaiBatch
+    from monitoring import load
+
+    df = load()
+    df = df[df['blockNumber'].astype(int) >= 15046690].reset_index(drop=True)
+    market_prices = np.array([int(x) / 1e27 for x in df['marketPrice']])
+    timestamps = df['ts'].astype(int).values
+    first = df.iloc[0]
+    n = 1000
+    kp = float(first['sg']) * np.geomspace(0.1, 10, n)
+
+    def run():
+        rai = RaiBatch(int(first['redemptionPrice']) / 1e27, int(first['redemptionRate']), timestamps[0],
+                       kp, float(first['ag']), int(first['pscl']))
+        rai.run(market_prices[1:], timestamps[1:])
+        return n * (len(timestamps) - 1)
+
+    return run
+
+def fetch_bench(worker, n_blocks, **kwargs):
+    from stubs import RPCStub
+    from mp import fetch
+    from abis import ORACLE_RELAYER, ORACLE_RELAYER_ABI, LINK_ETH, LINK_ETH_ABI
+
+    stub = RPCStub()
+    contract, abi = (LINK_ETH, LINK_ETH_ABI) if worker.__name__ == 'fetch_link_mp' else \
+                    (ORACLE_RELAYER, ORACLE_RELAYER_ABI)
+    blocks = list(range(14000000, 14000000 + n_blocks * 10, 10))
+
+    def run():
+        results = fetch(worker, 4, contract, abi, stub.url, blocks=blocks, **kwargs)
+        assert len(results) == n_blocks, f"{len(results)} of {n_blocks} blocks"
+        return n_blocks
+
+    return run
+
+def bench_fetch_rp_web3():
+    from mp import fetch_rp
+    return fetch_bench(fetch_rp, 400)
+
+def bench_fetch_link_batch():
+    from mp import fetch_link_mp
+    return fetch_bench(fetch_link_mp, 20000, batch_size=100)
+
+def bench_fetch_rp_async():
+    from mp import fetch_rp
+    return fetch_bench(fetch_rp, 20000, batch_size=100, engine='async')
+
+def bench_fetch_safes():
+    from stubs import GraphStub, synthetic_safes
+    from graph_util import fetch_safes
+
+    safes, saviours = synthetic_safes(20000)
+    stub = GraphStub(safes, saviours)
+
+    def run():
+        return len(fetch_safes(stub.url))
+
+    return run
+
+def shock_namespace():
+    """
+    Shock simulation functions and constants of the liquidation notebook, run on
+    synthetic SAFEs
+    """
+    from decimal import Decimal
+    import numpy as np
+    import pandas as pd
+    from stubs import synthetic_safes
+    from uniswap import buy_to_price, V2Pool, V3Pool, route_buy
+    from liquidation import SortedSafes
+
+    safes, saviours = synthetic_safes(20000)
+    orig_safes = pd.DataFrame(safes)[['safeId', 'collateral', 'debt']].astype({'collateral': float, 'debt': float})
+    saviour_safes = pd.DataFrame([s for x in saviours for s in x['safes']])[['safeId', 'collateral', 'debt']]
+    saviour_safes = saviour_safes.astype({'collateral': float, 'debt': float})
+    saviour_safes['lp_syscoin'] = saviour_safes['debt'] * 0.5
+
+    ns = {'np': np, 'pd': pd, 'Decimal': Decimal, 'buy_to_price': buy_to_price, 'SortedSafes': SortedSafes,
+          'V2Pool': V2Pool, 'V3Pool': V3Pool, 'route_buy': route_buy,
+          'ETH_USD': 3000., 'REDEMPTION_PRICE': 3.}
+    exec(notebook_code('ETH Shock Simulations and System Debt.ipynb',
+                       ['def update_cratios(', 'def liquidate_critical(', 'def run(orig_safes',
+                        'MAINNET_LIQ_RATIO = 1.40', 'min_shock = 0.01']), ns)
+    ns.update(orig_safes=orig_safes, saviour_safes=saviour_safes)
+    return ns
+
+def bench_shock_cratios():
+    ns = shock_namespace()
+
+    def run():
+        for shock in ns['SHOCKS']:
+            safes = ns['update_cratios'](ns['orig_safes'], ns['ETH_USD'] * (1 - shock), ns['REDEMPTION_PRICE'])
+            ns['liquidate_critical'](safes, ns['MAINNET_LIQ_RATIO'])
+        return len(ns['SHOCKS'])
+
+    return run
+
+def bench_shock_run():
+    ns = shock_namespace()
+    liq_ratios = [1.20, 1.25, 1.30, 1.35, 1.40]
+
+    def run():
+        safes = ns['SortedSafes'].from_frame(ns['orig_safes'])
+        saviour_safes = ns['SortedSafes'].from_frame(ns['saviour_safes'], columns=['lp_syscoin'])
+        for liq_ratio in liq_ratios:
+            ns['run'](safes, saviour_safes, liq_ratio, ns['SHOCKS'], ns['INITIAL_SURPLUS'])
+        return len(liq_ratios) * len(ns['SHOCKS'])
+
+    return run
+
+def bench_create_prod_twap():
+    import pandas as pd
+
+    from align import events, asof, asof_join
+    from oracles import grid_twap
+
+    rai = pd.read_csv('rai_eth.csv').rename(columns={'value': 'rai_eth'})
+    link = pd.read_csv('link_eth.csv.gz').rename(columns={'price': 'eth_usd_link', 'ts': 'time'})
+    link['eth_usd_link'] /= 1E8
+
+    # feeds aligned as-of at every observation, as in the TWAP notebook
+    df = asof_join({'rai_eth': events(rai)['rai_eth'], 'eth_usd_link': events(link, unit='s')['eth_usd_link']})
+    df = df.dropna()
+
+    ns = {'pd': pd, 'asof': asof, 'grid_twap': grid_twap}
+    exec(hourly_freq(notebook_code('TWAP.ipynb', ['def create_prod_twaps('])), ns)
+
+    def run():
+        ns['create_prod_twap'](df.copy(), 16, 4, 'eth_usd_link')
+        return len(df)
+
+    return run
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss * scale / 2**20
+
+def run_child(name, repeat):
+    sys.path.insert(0, os.getcwd())
+    sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+    run = globals()['bench_' + name]()
+
+    walls = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        calls = run()
+        walls.append(time.perf_counter() - start)
+
+    wall = statistics.median(walls)
+    spread = statistics.median(abs(w - wall) for w in walls) / wall
+    print(json.dumps({'wall': wall, 'spread': spread, 'calls': calls, 'calls_per_sec': calls / wall,
+                      'peak_rss_mb': peak_rss_mb()}))
+
+def slowdown_limit(result, base, tolerance, noise):
+    # relative slowdown within the noise of both measurements, older baselines have no spread
+    spread = (result.get('spread', 0)**2 + base.get('spread', 0)**2)**0.5
+    return max(tolerance, noise * spread)
+
+def run_benchmark(name, repeat):
+    directory, _ = BENCHMARKS[name]
+    p = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name, '--repeat', str(repeat)],
+                       cwd=os.path.join(ROOT, directory), capture_output=True, text=True)
+    if p.returncode != 0:
+        return {'error': p.stderr.strip().splitlines()[-1] if p.stderr.strip() else f'exit code {p.returncode}'}
+    return json.loads(p.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the fetch, simulation and TWAP paths')
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run, all by default: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--repeat', type=int, default=7, help='runs per benchmark, the median counts')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline results to compare with')
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown or RSS growth reported as a regression')
+    parser.add_argument('--noise', type=float, default=3,
+                        help='spreads of the runs a slowdown must also exceed to be a regression')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args.child, args.repeat)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<18} {'wall s':>9} {'spread':>8} {'calls/s':>12} {'rss MB':>8} {'vs baseline':>12}")
+    for name in args.names or BENCHMARKS:
+        result = results[name] = run_benchmark(name, args.repeat)
+        if 'error' in result:
+            print(f"{name:<18} error: {result['error']}")
+            regressions.append(name)
+            continue
+
+        change = ''
+        if name in baseline:
+            ratio = result['wall'] / baseline[name]['wall']
+            rss_ratio = result['peak_rss_mb'] / baseline[name]['peak_rss_mb']
+            limit = slowdown_limit(result, baseline[name], args.tolerance, args.noise)
+            change = f"{ratio:.2f}x"
+            if ratio > 1 + limit or rss_ratio > 1 + args.tolerance:
+                change += ' SLOWER' if ratio > 1 + limit else ' RSS'
+                regressions.append(name)
+        print(f"{name:<18} {result['wall']:>9.3f} {result['spread']:>8.1%} {result['calls_per_sec']:>12.1f} "
+              f"{result['peak_rss_mb']:>8.0f} {change:>12}")
+
+    if args.save:
+        baseline.update({k: v for k, v in results.items() if 'error' not in v})
+        with open(args.baseline, 'w') as fp:
+            json.dump(baseline, fp, indent=1, sort_keys=True)
+            fp.write('\n')
+        print(f"saved {args.baseline}")
+    elif regressions:
+        print(f"regressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
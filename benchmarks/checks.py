@@ -0,0 +1,159 @@
+"""
+Offline checks of the fetch paths against the local JSON-RPC and GraphQL stubs.
+
+As in bench.py, every check runs in its own process from the directory of the code
+it checks. A check passes when it returns, and fails on any exception.
+
+    python benchmarks/checks.py                   # run all
+    python benchmarks/checks.py batch_call_counts
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> (directory, description), the check itself is `check_<name>` below
+CHECKS = {
+    'batch_call_counts': ('fsm', 'batched fetch sends one request per batch and one eth_call per block and call, '
+                                 'or per block with Multicall3, and matches the web3 workers'),
+    'id_gt_pagination': ('liquidation_ratio', 'fetch_safes and fetch_saviour_safes page by id_gt through every '
+                                              'record once, in id order, with and without prefetch'),
+    'pool_failover': ('rai_usd', 'RPCPool fails over from a down or rate-limited node and backs it off, hedges a '
+                                 'slow one, gives up after its tries, and serves the web3 workers'),
+}
+
+def check_batch_call_counts():
+    from stubs import RPCStub
+    from mp import fetch, fetch_batch, fetch_rp, fetch_fsm, MULTICALL3_FIRST_BLOCK
+    from abis import FSM, FSM_ABI, ORACLE_RELAYER, ORACLE_RELAYER_ABI
+
+    stub = RPCStub()
+    n_blocks, batch_size = 250, 100
+    n_batches = -(-n_blocks // batch_size)
+    blocks = list(range(MULTICALL3_FIRST_BLOCK, MULTICALL3_FIRST_BLOCK + n_blocks * 10, 10))
+
+    # one call per block
+    expected = fetch(fetch_rp, 1, ORACLE_RELAYER, ORACLE_RELAYER_ABI, stub.url, blocks=blocks)
+    assert len(expected) == n_blocks, len(expected)
+    stub.n_requests = stub.n_calls = 0
+    results = fetch(fetch_rp, 1, ORACLE_RELAYER, ORACLE_RELAYER_ABI, stub.url, blocks=blocks, batch_size=batch_size)
+    assert results == expected, "batched redemption prices differ from the web3 worker's"
+    assert (stub.n_requests, stub.n_calls) == (n_batches, n_blocks), (stub.n_requests, stub.n_calls)
+
+    # two calls per block, packed into one aggregate3 call
+    expected = fetch(fetch_fsm, 1, FSM, FSM_ABI, stub.url, blocks=blocks)
+    assert len(expected) == n_blocks, len(expected)
+    stub.n_requests = stub.n_calls = 0
+    results = fetch(fetch_fsm, 1, FSM, FSM_ABI, stub.url, blocks=blocks, batch_size=batch_size)
+    assert results == expected, "batched FSM results differ from the web3 worker's"
+    assert (stub.n_requests, stub.n_calls) == (n_batches, n_blocks), (stub.n_requests, stub.n_calls)
+
+    # and without Multicall3, or before it was deployed
+    for multicall, first_block in [(False, MULTICALL3_FIRST_BLOCK), (True, MULTICALL3_FIRST_BLOCK - n_blocks)]:
+        stub.n_requests = stub.n_calls = 0
+        results = fetch_batch(fetch_fsm, FSM, FSM_ABI, stub.url, range(first_block, first_block + n_blocks),
+                              batch_size, multicall=multicall)
+        assert len(results) == n_blocks, len(results)
+        assert (stub.n_requests, stub.n_calls) == (n_batches, 2 * n_blocks), (stub.n_requests, stub.n_calls)
+
+def check_id_gt_pagination():
+    from stubs import GraphStub, synthetic_safes
+    from graph_util import fetch_safes, fetch_saviour_safes
+
+    safes, saviours = synthetic_safes(2500, n_saviours=30)
+    stub = GraphStub(safes, saviours)
+    ids = [x['safeId'] for x in safes]
+
+    # a short last page, and a full one followed by an empty page
+    for page_size in (1000, 500):
+        n_pages = len(safes) // page_size + 1
+        for prefetch in (True, False):
+            stub.n_requests = 0
+            df = fetch_safes(stub.url, page_size=page_size, prefetch=prefetch, block=15000000)
+            assert list(df['safeId']) == ids, f"page_size={page_size}, prefetch={prefetch}"
+            assert df['debt'].dtype == float
+            assert list(df['collateral']) == [float(x['collateral']) for x in safes]
+            assert stub.n_requests == n_pages, (page_size, prefetch, stub.n_requests)
+
+    df = fetch_saviour_safes(stub.url, page_size=7)
+    assert list(df['safeId']) == [x['safeId'] for s in saviours for x in s['safes']]
+    assert list(df['safeHandler']) == [x['safeHandler'] for s in saviours for x in s['safes']]
+
+def check_pool_failover():
+    import time
+    from stubs import RPCStub
+    from rpc_pool import RPCPool, RPCPoolError
+    from mp import fetch, fetch_rp
+    from abis import ORACLE_RELAYER, ORACLE_RELAYER_ABI
+
+    good = RPCStub()
+    payload = [{'jsonrpc': '2.0', 'id': i, 'method': 'eth_blockNumber', 'params': []} for i in range(3)]
+    expected = [{'jsonrpc': '2.0', 'id': i, 'result': hex(good.head)} for i in range(3)]
+
+    # a node answering 503, or rate limit errors inside a 200 batch, is tried first as
+    # the endpoints are unmeasured, then backed off while the other serves
+    for bad in (RPCStub(status=503), RPCStub(rate_limited=True)):
+        pool = RPCPool([bad.url, good.url], hedge=False, backoff=60)
+        for _ in range(20):
+            assert pool.post(payload) == expected
+        assert bad.n_requests == 1, bad.n_requests
+        assert pool.stats().loc[bad.url, 'errors'] == 1 and pool.stats().loc[bad.url, 'backoff'] > 50
+
+    # a request still pending on a slow node is sent to the next one, whose answer wins
+    slow = RPCStub(latency=1)
+    pool = RPCPool([slow.url, good.url], timeout=2)
+    start = time.monotonic()
+    assert pool.post(payload) == expected
+    assert time.monotonic() - start < 1, time.monotonic() - start
+    assert (pool.n_hedged, pool.n_hedge_wins) == (1, 1), (pool.n_hedged, pool.n_hedge_wins)
+
+    # every node down
+    down = [RPCStub(status=503) for _ in range(2)]
+    pool = RPCPool([x.url for x in down], backoff=0.01, tries=4)
+    try:
+        pool.post(payload)
+        raise AssertionError("a pool of down nodes answered")
+    except RPCPoolError:
+        pass
+    assert sum(x.n_requests for x in down) == 4, [x.n_requests for x in down]
+
+    # the web3 workers in their own processes, through the pool's provider
+    blocks = list(range(15000000, 15000200))
+    expected = fetch(fetch_rp, 2, ORACLE_RELAYER, ORACLE_RELAYER_ABI, good.url, blocks=blocks)
+    assert len(expected) == len(blocks), len(expected)
+    pool = RPCPool([RPCStub(status=503).url, good.url], hedge=False)
+    assert fetch(fetch_rp, 2, ORACLE_RELAYER, ORACLE_RELAYER_ABI, pool, blocks=blocks) == expected
+
+def run_check(name):
+    directory, _ = CHECKS[name]
+    p = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name],
+                       cwd=os.path.join(ROOT, directory), capture_output=True, text=True)
+    if p.returncode != 0:
+        return p.stderr.strip().splitlines()[-1] if p.stderr.strip() else f'exit code {p.returncode}'
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline checks of the fetch paths against local stubs')
+    parser.add_argument('names', nargs='*', help=f"checks to run, all by default: {', '.join(CHECKS)}")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, os.getcwd())
+        sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+        return globals()['check_' + args.child]()
+
+    failures = []
+    for name in args.names or CHECKS:
+        error = run_check(name)
+        print(f"{name:<22} {'FAIL: ' + error if error else 'ok'}")
+        if error:
+            failures.append(name)
+
+    if failures:
+        print(f"failures: {', '.join(failures)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+import os
+import re
+import json
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+from eth_abi import encode, decode
+from eth_utils import function_abi_to_4byte_selector
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Chainlink ETH/USD answers and redemption prices recorded every ~1h of blocks
+ETH_USD_FIXTURE = os.path.join(ROOT, 'rai_usd', 'eth_usd_1h_blocks.csv.gz')
+REDEMPTION_PRICE_FIXTURE = os.path.join(ROOT, 'rai_usd', 'redemption_price_1h_blocks.csv.gz')
+
+def selector(name, inputs=()):
+    fn_abi = {'name': name, 'type': 'function', 'inputs': [{'type': t} for t in inputs]}
+    return '0x' + function_abi_to_4byte_selector(fn_abi).hex()
+
+class Server():
+    """
+    Local HTTP server answering JSON POST bodies with `self.answer`, in a daemon thread.
+    Every request fails with HTTP `status` when it is set, ie. 503 for a node that is down.
+    """
+    def __init__(self, latency=0, status=None):
+        self.latency = latency
+        self.status = status
+        self.n_requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                server.n_requests += 1
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if server.latency:
+                    time.sleep(server.latency)
+                data = json.dumps(server.answer(body) if server.status is None else {}).encode()
+                try:
+                    self.send_response(server.status or 200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up, ie. a timed out request
+                    pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class RPCStub(Server):
+    """
+    JSON-RPC node serving recorded contract values.
+
+    `eth_call`s of `latestRoundData` and `redemptionPrice`, also inside Multicall3
+    `aggregate3`, return the last recorded value at or before the block, whatever the
+    target address. The FSM getters return the ETH/USD answer as valid. Enough for
+    `mp.fetch` with its workers in every mode. `n_calls` counts JSON-RPC requests, an
+    `aggregate3` as one. With `rate_limited`, every request of a batch is answered
+    with a rate limit error inside a 200 response, as Infura does.
+    """
+    def __init__(self, latency=0, status=None, rate_limited=False, eth_usd=ETH_USD_FIXTURE,
+                 redemption_price=REDEMPTION_PRICE_FIXTURE):
+        super().__init__(latency, status)
+        self.rate_limited = rate_limited
+        link = pd.read_csv(eth_usd)
+        rp = pd.read_csv(redemption_price, dtype={'price': str})
+        self.link_blocks = link['block'].values
+        self.link = link[['price', 'ts', 'started_at']].values.tolist()
+        self.rp_blocks = rp['block'].values
+        self.rp = [int(x) for x in rp['price']]
+        self.head = int(max(self.link_blocks[-1], self.rp_blocks[-1]))
+        self.n_calls = 0
+
+        self.handlers = {
+            selector('latestRoundData'): self.latest_round_data,
+            selector('redemptionPrice'): self.redemption_price,
+            selector('getResultWithValidity'): self.fsm_result,
+            selector('getNextResultWithValidity'): self.fsm_result,
+            selector('aggregate3', ['(address,bool,bytes)[]']): self.aggregate3,
+        }
+
+    @staticmethod
+    def at(blocks, block):
+        return max(np.searchsorted(blocks, block, side='right') - 1, 0)
+
+    def latest_round_data(self, data, block):
+        price, ts, started_at = self.link[self.at(self.link_blocks, block)]
+        return encode(['uint80', 'int256', 'uint256', 'uint256', 'uint80'], [1, int(price), started_at, ts, 1])
+
+    def redemption_price(self, data, block):
+        return encode(['uint256'], [self.rp[self.at(self.rp_blocks, block)]])
+
+    def fsm_result(self, data, block):
+        price = self.link[self.at(self.link_blocks, block)][0]
+        return encode(['uint256', 'bool'], [int(price), True])
+
+    def aggregate3(self, data, block):
+        (calls,) = decode(['(address,bool,bytes)[]'], bytes.fromhex(data[10:]))
+        return encode(['(bool,bytes)[]'], [[(True, self.call('0x' + c.hex(), block)) for _, _, c in calls]])
+
+    def call(self, data, block):
+        return self.handlers[data[:10]](data, block)
+
+    def result(self, request):
+        self.n_calls += 1
+        method, params = request['method'], request.get('params', [])
+        if method == 'eth_call':
+            block = self.head if params[1] == 'latest' else int(params[1], 16)
+            return '0x' + self.call(params[0]['data'], block).hex()
+        if method == 'eth_blockNumber':
+            return hex(self.head)
+        if method == 'eth_chainId':
+            return '0x1'
+        if method == 'eth_getBlockByNumber':
+            return {'number': params[0], 'timestamp': hex(1600000000)}
+        raise ValueError(f"unsupported method {method}")
+
+    def answer(self, body):
+        requests = body if isinstance(body, list) else [body]
+        if self.rate_limited:
+            error = {'code': -32005, 'message': 'request rate limited'}
+            responses = [{'jsonrpc': '2.0', 'id': r['id'], 'error': error} for r in requests]
+        else:
+            responses = [{'jsonrpc': '2.0', 'id': r['id'], 'result': self.result(r)} for r in requests]
+        return responses if isinstance(body, list) else responses[0]
+
+def synthetic_safes(n_safes=20000, n_saviours=20, seed=0):
+    """
+    SAFE and saviour records shaped like the RAI subgraph's, with lognormal
+    collateral and c-ratios above 1.3
+    """
+    rng = np.random.default_rng(seed)
+    collateral = rng.lognormal(1, 2, n_safes)
+    cratio = 1.3 + rng.lognormal(0, 0.7, n_safes)
+    debt = collateral * 3000 / (cratio * 3)
+    safes = [{'id': f'{i:08d}', 'safeId': str(i), 'collateral': str(float(c)), 'debt': str(float(d)),
+              'safeHandler': f'0x{i:040x}'}
+             for i, (c, d) in enumerate(zip(collateral, debt))]
+    saviours = [{'id': f's{j:04d}', 'safes': safes[j * 10:(j + 1) * 10]} for j in range(n_saviours)]
+    return safes, saviours
+
+class GraphStub(Server):
+    """
+    RAI subgraph serving `safes` and `safeSaviours` with `id_gt` keyset pagination,
+    the redemption price, the debt ceiling and `_meta`
+    """
+    def __init__(self, safes, saviours, latency=0, redemption_price='3.0', debt_ceiling='100000000'):
+        super().__init__(latency)
+        self.entities = {'safes': safes, 'safeSaviours': saviours}
+        self.ids = {name: [r['id'] for r in records] for name, records in self.entities.items()}
+        self.redemption_price = redemption_price
+        self.debt_ceiling = debt_ceiling
+
+    def answer(self, body):
+        query = body['query']
+        if '_meta' in query:
+            data = {'_meta': {'block': {'number': 15000000}}}
+        elif 'systemState' in query:
+            data = {'systemState': {'currentRedemptionPrice': {'value': self.redemption_price}}}
+        elif 'collateralType' in query:
+            data = {'collateralType': {'debtCeiling': self.debt_ceiling}}
+        else:
+            entity = re.search(r'(\w+)\((?:block: \{number: \d+\}, )?first', query).group(1)
+            first = int(re.search(r'first: (\d+)', query).group(1))
+            last_id = re.search(r'id_gt: "([^"]*)"', query).group(1)
+            start = bisect.bisect_right(self.ids[entity], last_id)
+            data = {entity: self.entities[entity][start:start + first]}
+        return {'data': data}
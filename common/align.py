@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+
+def events(df, time_col='time', unit=None, format=None):
+    '''
+    Feed `df` as event-time observations: indexed by UTC time, sorted, keeping the
+    last observation of duplicated timestamps.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Raw feed, ie. a csv of Chainlink answers or subgraph states
+    time_col : str
+        Column of observation times, strings, datetimes or epochs
+    unit : str
+        Unit of epoch times, ie. 's' for the Chainlink and block timestamps
+    format : str
+        Format of time strings, ie. 'ISO8601' when some have fractional seconds
+    Returns
+    -------
+    pd.DataFrame
+    '''
+    times = pd.to_datetime(df[time_col], unit=unit, utc=True, format=format)
+    df = df.drop(columns=[time_col]).set_index(pd.DatetimeIndex(times, name='time'))
+    df = df.sort_index(kind='stable')
+    return df[~df.index.duplicated(keep='last')]
+
+def _ns(times):
+    return pd.DatetimeIndex(times).as_unit('ns').asi8
+
+def _delta_ns(delta):
+    return pd.Timedelta(delta).value
+
+def asof(feed, at, tolerance=None):
+    '''
+    Last value of `feed` at or before each time of `at`, nan before the first
+    observation or when the last one is older than `tolerance`.
+
+    Parameters
+    ----------
+    feed : pd.Series
+        Observations indexed by sorted time, see `events`
+    at : pd.DatetimeIndex
+        Query times
+    tolerance : str or pd.Timedelta
+        Staleness limit, ie. '1h'
+    Returns
+    -------
+    np.ndarray
+    '''
+    t = _ns(feed.index)
+    q = _ns(at)
+    i = np.searchsorted(t, q, side='right') - 1
+
+    values = feed.to_numpy(dtype=float)[np.maximum(i, 0)]
+    stale = i < 0
+    if tolerance is not None:
+        stale |= q - t[np.maximum(i, 0)] > _delta_ns(tolerance)
+    return np.where(stale, np.nan, values)
+
+def asof_join(feeds, at=None, tolerance=None):
+    '''
+    Align any number of irregular feeds with as-of semantics.
+
+    Each row holds the latest observation of every feed at that time, so memory is
+    proportional to the number of observations instead of the minutes covered,
+    unlike forward filling each feed onto a 1 minute grid before merging.
+
+    Parameters
+    ----------
+    feeds : dict
+        Column name -> pd.Series indexed by time
+    at : pd.DatetimeIndex
+        Times of the rows, defaults to the union of all observation times
+    tolerance : str, pd.Timedelta or dict
+        Staleness limit of all feeds, or per column name
+    Returns
+    -------
+    pd.DataFrame
+    '''
+    if at is None:
+        at = pd.DatetimeIndex(np.unique(np.concatenate([_ns(f.index) for f in feeds.values()])), tz='UTC')
+    if not isinstance(tolerance, dict):
+        tolerance = {name: tolerance for name in feeds}
+
+    return pd.DataFrame({name: asof(feed, at, tolerance.get(name)) for name, feed in feeds.items()},
+                        index=pd.DatetimeIndex(at, name='time'))
+
+def sample(feed, freq, tolerance=None, start=None, end=None):
+    '''
+    Value of `feed` at every `freq` boundary, ie. what
+    `asfreq('1min', method='ffill').resample('4h').first()` gives on the minute grid,
+    except for a first boundary before the first observation, which is nan
+    '''
+    start = pd.Timestamp(start or feed.index[0]).floor(freq)
+    at = pd.date_range(start, end or feed.index[-1], freq=freq)
+    return pd.Series(asof(feed, at, tolerance), index=at, name=feed.name)
+
+def time_weighted_mean(feed, window, at=None):
+    '''
+    Time weighted mean of `feed` over the `window` before each time of `at`.
+
+    The feed holds each value until the next observation, so the mean is a
+    difference of its running integral, read with searchsorted at both window ends.
+    Windows starting before the first observation average over the time since it,
+    as `rolling` does on a forward filled grid.
+
+    Parameters
+    ----------
+    feed : pd.Series
+        Observations indexed by sorted time
+    window : str or pd.Timedelta
+        ie. '16h'
+    at : pd.DatetimeIndex
+        Query times, defaults to the observation times
+    Returns
+    -------
+    pd.Series
+    '''
+    t = _ns(feed.index)
+    v = feed.to_numpy(dtype=float)
+    at = feed.index if at is None else at
+    q = _ns(at)
+    # integral from the first observation to each observation
+    cum = np.concatenate([[0.], np.cumsum(v[:-1] * np.diff(t))])
+
+    def integral(x):
+        x = np.maximum(x, t[0])
+        i = np.searchsorted(t, x, side='right') - 1
+        return cum[i] + v[i] * (x - t[i])
+
+    start = np.maximum(q - _delta_ns(window), t[0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (integral(q) - integral(start)) / (q - start)
+    # a window of zero length is the current value
+    mean = np.where(q > start, mean, v[np.maximum(np.searchsorted(t, q, side='right') - 1, 0)])
+    mean = np.where(q < t[0], np.nan, mean)
+
+    return pd.Series(mean, index=at, name=feed.name)
@@ -0,0 +1,204 @@
+import json
+import time
+import asyncio
+import aiohttp
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+from mp import BATCH_CALLS, encode_calls, build_batch, decode_batch
+from rpc_pool import RPCPool, rate_limited
+from metrics import METRICS, count_rpc
+
+class Throttled(Exception):
+    def __init__(self, retry_after=None):
+        super().__init__(f"throttled by provider, retry after {retry_after}")
+        self.retry_after = retry_after
+
+class AdaptiveLimiter():
+    """
+    Bounds the number of in-flight requests. The limit grows by one every time a
+    full window of requests completes under `target_latency` and is halved when the
+    provider throttles us or latency exceeds `target_latency` (AIMD).
+    """
+    def __init__(self, max_concurrency=64, min_concurrency=1, initial_concurrency=8, target_latency=2.0):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(min(initial_concurrency, max_concurrency))
+        self.target_latency = target_latency
+
+        self.in_flight = 0
+        self.latency = None # EWMA of request latency in secs
+        self.n_throttled = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self, latency):
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if self.latency > self.target_latency:
+            self.limit = max(self.min_concurrency, self.limit * 0.9)
+        else:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def on_throttle(self):
+        self.n_throttled += 1
+        self.limit = max(self.min_concurrency, self.limit / 2)
+
+async def post_batch_async(session, eth_rpc_url, payload, timeout=10):
+    if isinstance(eth_rpc_url, RPCPool):
+        # the pool retries, fails over and counts on its own threads
+        responses = await asyncio.get_running_loop().run_in_executor(None, eth_rpc_url.post, payload)
+        return sorted(responses, key=lambda x: x['id'])
+
+    count_rpc(payload)
+    data = json.dumps(payload)
+    with METRICS.timer('rpc_seconds', method='batch'):
+        async with session.post(eth_rpc_url, data=data, headers={'Content-Type': 'application/json'},
+                                timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+            if r.status == 429:
+                retry_after = r.headers.get('Retry-After')
+                raise Throttled(float(retry_after) if retry_after else None)
+            r.raise_for_status()
+            body = await r.read()
+    METRICS.transfer(len(data), len(body))
+    responses = json.loads(body)
+
+    if isinstance(responses, dict):
+        if rate_limited(responses.get('error')):
+            raise Throttled()
+        raise ValueError(f"batch request failed: {responses.get('error')}")
+    if any(rate_limited(x.get('error')) for x in responses):
+        raise Throttled()
+
+    return sorted(responses, key=lambda x: x['id'])
+
+async def fetch_stream(f, contract, abi, eth_rpc_url, block_numbers, batch_size=100, multicall=True,
+                       max_concurrency=64, target_latency=2.0, tries=5, max_throttled=20, cache=None):
+    """
+    Async generator yielding the results of worker `f` one batch at a time, as
+    batches complete.
+
+    At most `max_concurrency` batches are in progress: each of as many workers takes
+    the next `batch_size` blocks of `block_numbers` when it is free, and builds the
+    batch's payload once the limiter lets it send. Completed batches wait in a queue
+    of the same size until they are consumed, so memory does not grow with the
+    block range.
+
+    Parameters
+    ----------
+    f : function
+        worker function in `BATCH_CALLS`, ie. fetch_rp
+    eth_rpc_url : str or rpc_pool.RPCPool
+        ethereum rpc url, or a pool of them
+    block_numbers : iterable[int]
+        Block numbers to fetch
+    batch_size : int
+        Number of blocks per JSON-RPC batch request
+    max_concurrency : int
+        Upper bound on in-flight batch requests
+    target_latency : float
+        Request latency in secs above which concurrency is reduced
+    tries : int
+        Attempts per batch for errors other than throttling
+    max_throttled : int
+        Attempts per batch while the provider throttles
+    cache : cache.CallCache
+        Cache to store fetched return data in
+    Yields
+    ------
+    list[tuple]
+        Results in the same format `f` puts on its queue, unsorted across batches.
+        Blocks of batches given up on are printed and recorded with `METRICS.skip`.
+    """
+    fn_names, build_row = BATCH_CALLS[f]
+    calls = encode_calls(abi, fn_names)
+    limiter = AdaptiveLimiter(max_concurrency, target_latency=target_latency)
+
+    block_numbers = iter(block_numbers)
+    batches = iter(lambda: list(islice(block_numbers, batch_size)), [])
+    completed = asyncio.Queue(maxsize=max_concurrency)
+
+    async def run_batch(session, blocks):
+        errors = 0
+        throttled = 0
+        while True:
+            async with limiter:
+                payload, block_ids = build_batch(contract, calls, blocks, multicall)
+                start = time.monotonic()
+                try:
+                    responses = await post_batch_async(session, eth_rpc_url, payload)
+                except Throttled as e:
+                    limiter.on_throttle()
+                    throttled += 1
+                    error = e
+                    delay = e.retry_after or min(2 ** limiter.n_throttled, 30) * 0.1
+                    METRICS.count('rpc_retries_total', reason='throttled')
+                except Exception as e:
+                    errors += 1
+                    error = e
+                    delay = errors
+                    METRICS.count('rpc_retries_total', reason='error')
+                else:
+                    limiter.on_success(time.monotonic() - start)
+                    return decode_batch(calls, build_row, block_ids, responses, contract, cache)
+
+            if errors >= tries or throttled >= max_throttled:
+                print(error, f"skipping blocks {blocks[0]}-{blocks[-1]}")
+                METRICS.skip(blocks, error, 'fetch_stream')
+                return []
+            await asyncio.sleep(delay)
+
+    async def worker(session):
+        # the shared `batches` iterator hands each batch to one worker
+        for blocks in batches:
+            await completed.put(await run_batch(session, blocks))
+
+    async def run_workers(session):
+        try:
+            await asyncio.gather(*[worker(session) for _ in range(max_concurrency)])
+        finally:
+            await completed.put(None)
+
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        workers = asyncio.ensure_future(run_workers(session))
+        try:
+            while (batch := await completed.get()) is not None:
+                yield batch
+            # raise a worker's exception, if any
+            await workers
+        finally:
+            workers.cancel()
+
+async def fetch_async(f, contract, abi, eth_rpc_url, block_numbers, on_result=None, **kwargs):
+    """
+    Collect all results of `fetch_stream`, sorted by block.
+    `on_result` is called with each batch of results as it completes.
+    """
+    results = []
+    async for batch in fetch_stream(f, contract, abi, eth_rpc_url, block_numbers, **kwargs):
+        if on_result:
+            on_result(batch)
+        results.extend(batch)
+
+    return sorted(results, key=lambda x: x[0])
+
+def run(coro):
+    """
+    Run `coro` to completion, also from inside a running event loop (ie. Jupyter)
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coro).result()
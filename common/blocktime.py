@@ -0,0 +1,160 @@
+import os
+import numpy as np
+import requests
+
+from mp import post_batch
+
+def merge(data, new):
+    # (block, timestamp) pairs of both sorted by block, the first of duplicate blocks kept
+    data = np.concatenate([np.asarray(data), new])
+    if len(data) == 0:
+        return data
+    data = data[np.argsort(data[:, 0], kind='stable')]
+    return data[np.concatenate([[True], np.diff(data[:, 0]) > 0])]
+
+class BlockIndex():
+    """
+    Persistent block <-> timestamp index.
+
+    Known (block, timestamp) pairs are kept sorted in an .npy file that is memory
+    mapped on open, so lookups are searchsorted on disk pages. Block timestamps are
+    strictly increasing, so any timestamp is bracketed by two known blocks. Lookups
+    that are not exact yet probe the chain at the block interpolated between the
+    bracketing pairs, all targets in one batch request per round, and every header
+    fetched is added to the index.
+
+    Added pairs are appended to a log next to the file, `path` + '.log', and only
+    merged into the .npy file by `compact`, once the log holds `compact_every` pairs.
+    """
+    def __init__(self, path='block_index.npy', compact_every=100000):
+        self.path = path
+        self.log_path = path + '.log'
+        self.compact_every = compact_every
+        if os.path.exists(path):
+            self.data = np.load(path, mmap_mode='r')
+        else:
+            self.data = np.empty((0, 2), dtype=np.int64)
+
+        self.n_logged = 0
+        if os.path.exists(self.log_path):
+            # a write cut short by a crash leaves a partial last pair, ignored
+            logged = np.fromfile(self.log_path, dtype=np.int64)
+            logged = logged[:len(logged) // 2 * 2].reshape(-1, 2)
+            self.n_logged = len(logged)
+            self.data = merge(self.data, logged)
+
+    def __len__(self):
+        return len(self.data)
+
+    def blocks(self):
+        return self.data[:, 0]
+
+    def timestamps(self):
+        return self.data[:, 1]
+
+    def add(self, blocks, timestamps):
+        """
+        Merge (block, timestamp) pairs into the index and append them to the log
+        """
+        new = np.column_stack([np.asarray(blocks, dtype=np.int64), np.asarray(timestamps, dtype=np.int64)])
+        with open(self.log_path, 'ab') as fp:
+            fp.write(new.tobytes())
+        self.n_logged += len(new)
+        self.data = merge(self.data, new)
+        if self.n_logged >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the .npy file with every pair of the index and remove the log
+        """
+        tmp = self.path + '.tmp.npy'
+        np.save(tmp, np.asarray(self.data))
+        os.replace(tmp, self.path)
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        self.n_logged = 0
+        self.data = np.load(self.path, mmap_mode='r')
+
+    def check_not_empty(self):
+        if len(self) == 0:
+            raise ValueError(f"block index {self.path} is empty, pass eth_rpc_url to fetch blocks")
+
+    def fetch(self, eth_rpc_url, blocks, batch_size=100, session=None):
+        """
+        Fetch the timestamps of `blocks` ('latest' allowed) with batch requests and add them
+        """
+        session = session or requests.Session()
+        blocks = list(blocks)
+        found = []
+        for i in range(0, len(blocks), batch_size):
+            payload = [{'jsonrpc': '2.0', 'id': j, 'method': 'eth_getBlockByNumber',
+                        'params': [n if isinstance(n, str) else hex(int(n)), False]}
+                       for j, n in enumerate(blocks[i:i + batch_size])]
+            for r in post_batch(session, eth_rpc_url, payload):
+                if r.get('result'):
+                    found.append((int(r['result']['number'], 16), int(r['result']['timestamp'], 16)))
+        if found:
+            self.add(*zip(*found))
+        return found
+
+    def timestamp(self, blocks, eth_rpc_url=None):
+        """
+        Timestamps of `blocks`. Blocks missing from the index are fetched when
+        `eth_rpc_url` is given, otherwise interpolated between known blocks.
+        """
+        blocks = np.asarray(blocks, dtype=np.int64)
+        if eth_rpc_url is not None:
+            missing = np.unique(blocks[~np.isin(blocks, self.blocks())])
+            if len(missing):
+                self.fetch(eth_rpc_url, missing.tolist())
+        self.check_not_empty()
+        return np.interp(blocks, self.blocks(), self.timestamps())
+
+    def block_at(self, timestamps, eth_rpc_url=None, max_rounds=64, batch_size=100):
+        """
+        Last block with a timestamp at or before each of `timestamps`.
+
+        Without `eth_rpc_url` the answer is interpolated from the index and is exact
+        only where the index holds the bracketing blocks. With it, unresolved targets
+        are probed until exact: interpolation first, as block times are nearly
+        regular, alternating with bisection so a bad guess cannot stall a target.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if eth_rpc_url is None:
+            self.check_not_empty()
+            return np.floor(np.interp(timestamps, self.timestamps(), self.blocks())).astype(np.int64)
+
+        session = requests.Session()
+        if len(self) == 0 or self.timestamps()[-1] < timestamps.max():
+            self.fetch(eth_rpc_url, ['latest'], session=session)
+        if len(self) < 2 or (self.blocks()[0] > 0 and self.timestamps()[0] > timestamps.min()):
+            self.fetch(eth_rpc_url, [0], session=session)
+
+        for n_round in range(max_rounds):
+            b = np.asarray(self.blocks())
+            t = np.asarray(self.timestamps())
+            i = np.clip(np.searchsorted(t, timestamps, side='right') - 1, 0, len(b) - 2)
+            lo_b, hi_b, lo_t, hi_t = b[i], b[i + 1], t[i], t[i + 1]
+            open_ = (hi_b - lo_b > 1) & (timestamps < hi_t) & (timestamps >= lo_t)
+            if not open_.any():
+                break
+
+            lo_b, hi_b, lo_t, hi_t = lo_b[open_], hi_b[open_], lo_t[open_], hi_t[open_]
+            if n_round % 2 == 0:
+                probe = lo_b + (timestamps[open_] - lo_t) * (hi_b - lo_b) // np.maximum(hi_t - lo_t, 1)
+            else:
+                probe = (lo_b + hi_b) // 2
+            probe = np.clip(probe, lo_b + 1, hi_b - 1)
+            self.fetch(eth_rpc_url, np.unique(probe).tolist(), batch_size, session)
+
+        t = np.asarray(self.timestamps())
+        i = np.searchsorted(t, timestamps, side='right') - 1
+        return np.asarray(self.blocks())[np.maximum(i, 0)]
+
+    def blocks_every(self, start, stop, seconds, eth_rpc_url=None):
+        """
+        Blocks at every `seconds` from timestamp `start` to `stop`, ie. a daily sweep
+        with seconds=86400 instead of a fixed block interval
+        """
+        return self.block_at(np.arange(start, stop + 1, seconds), eth_rpc_url)
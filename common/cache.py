@@ -0,0 +1,121 @@
+import os
+import sqlite3
+
+# Blocks this far behind head are treated as final and cached forever
+FINALITY_DEPTH = 64
+
+class CallCache():
+    """
+    On-disk cache of eth_call return data keyed by (chain_id, contract, calldata, block).
+
+    State at a finalized block never changes, so entries never expire. Only blocks at
+    or below `finalized_block` are written. Calls that ran and failed, ie. reverted
+    or returned nothing before the contract was deployed, are cached as failures so
+    they are not fetched again. Errors of the node or the network are not cached.
+
+    The connection is opened on first use in each process: a cache pickled to a
+    worker or inherited through fork opens its own, as SQLite connections must not
+    be used across fork.
+    """
+    def __init__(self, path='eth_call_cache.sqlite', chain_id=1, finalized_block=None):
+        self.path = path
+        self.chain_id = chain_id
+        self.finalized_block = finalized_block
+        self._conn = None
+        self._pid = None
+        self._inherited = []
+
+    @property
+    def conn(self):
+        if self._pid != os.getpid():
+            if self._conn is not None:
+                # the parent's connection, kept unused and unclosed in this process
+                self._inherited.append(self._conn)
+            self._conn = self._connect()
+            self._pid = os.getpid()
+        return self._conn
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS calls (
+                           chain_id INTEGER NOT NULL,
+                           contract TEXT NOT NULL,
+                           calldata TEXT NOT NULL,
+                           block INTEGER NOT NULL,
+                           result BLOB NOT NULL,
+                           PRIMARY KEY (chain_id, contract, calldata, block)
+                        ) WITHOUT ROWID''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS failed_calls (
+                           chain_id INTEGER NOT NULL,
+                           contract TEXT NOT NULL,
+                           calldata TEXT NOT NULL,
+                           block INTEGER NOT NULL,
+                           error TEXT NOT NULL,
+                           PRIMARY KEY (chain_id, contract, calldata, block)
+                        ) WITHOUT ROWID''')
+        return conn
+
+    def __getstate__(self):
+        return {'path': self.path, 'chain_id': self.chain_id, 'finalized_block': self.finalized_block}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._conn = None
+        self._pid = None
+        self._inherited = []
+
+    def get(self, contract, calldata, blocks):
+        """
+        Returns dict[block -> bytes] of the cached results of `calldata` at `blocks`
+        """
+        blocks = set(blocks)
+        if not blocks:
+            return {}
+        rows = self.conn.execute('''SELECT block, result FROM calls
+                                    WHERE chain_id = ? AND contract = ? AND calldata = ?
+                                    AND block BETWEEN ? AND ?''',
+                                 (self.chain_id, contract.lower(), calldata, min(blocks), max(blocks)))
+
+        return {n: result for n, result in rows if n in blocks}
+
+    def put(self, contract, calldata, results):
+        """
+        Store `results`, an iterable of (block, bytes), skipping blocks that are not final
+        """
+        rows = [(self.chain_id, contract.lower(), calldata, n, result) for n, result in results
+                if self.finalized_block is not None and n <= self.finalized_block]
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO calls VALUES (?, ?, ?, ?, ?)', rows)
+
+    def failed(self, contract, calldata, blocks):
+        """
+        Returns dict[block -> error] of the cached failures of `calldata` at `blocks`
+        """
+        blocks = set(blocks)
+        if not blocks:
+            return {}
+        rows = self.conn.execute('''SELECT block, error FROM failed_calls
+                                    WHERE chain_id = ? AND contract = ? AND calldata = ?
+                                    AND block BETWEEN ? AND ?''',
+                                 (self.chain_id, contract.lower(), calldata, min(blocks), max(blocks)))
+
+        return {n: error for n, error in rows if n in blocks}
+
+    def put_failed(self, contract, calldata, failures):
+        """
+        Store `failures`, an iterable of (block, error message), skipping blocks that are not final
+        """
+        rows = [(self.chain_id, contract.lower(), calldata, n, str(error)) for n, error in failures
+                if self.finalized_block is not None and n <= self.finalized_block]
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO failed_calls VALUES (?, ?, ?, ?, ?)', rows)
+
+    def blocks(self, contract, calldata):
+        """
+        Returns the sorted block numbers cached for `calldata`
+        """
+        rows = self.conn.execute('''SELECT block FROM calls WHERE chain_id = ? AND contract = ? AND calldata = ?
+                                    ORDER BY block''', (self.chain_id, contract.lower(), calldata))
+
+        return [n for (n,) in rows]
@@ -0,0 +1,139 @@
+import time
+import numpy as np
+import requests
+from web3 import Web3
+
+from cache import FINALITY_DEPTH
+from rpc_pool import provider
+from mp import BATCH_CALLS, encode_calls, build_batch, post_batch, decode_batch, call_failed, cached_results
+
+def fetch_values(f, contract, abi, eth_rpc_url, blocks, key, batch_size, session, cache, tries=3):
+    """
+    Returns {block: (row, value)} of `blocks`.
+
+    Blocks where the call ran and failed, ie. reverted before deployment, have a None
+    row and value. Blocks failing for any other reason, ie. a rate limit or a node
+    missing the state, are fetched again up to `tries` times and raise ValueError
+    after that, as a missing value would otherwise be taken for a change.
+
+    Blocks fully in `cache` or cached as failed are not fetched.
+    """
+    fn_names, build_row = BATCH_CALLS[f]
+    calls = encode_calls(abi, fn_names)
+    values = {}
+    pending = list(blocks)
+    if cache and pending:
+        results, pending = cached_results(cache, f, contract, abi, pending)
+        values = {row[0]: (row, key(row)) for row in results}
+        # blocks in neither are cached as failed
+        missing = set(pending)
+        values.update({n: (None, None) for n in blocks if n not in values and n not in missing})
+    for attempt in range(tries):
+        retry = []
+        for i in range(0, len(pending), batch_size):
+            chunk = pending[i:i + batch_size]
+            payload, block_ids = build_batch(contract, calls, chunk)
+            try:
+                responses = post_batch(session, eth_rpc_url, payload)
+            except Exception:
+                retry.extend(chunk)
+                continue
+            rows = {row[0]: row for row in decode_batch(calls, build_row, block_ids, responses, contract, cache)}
+            for n, ids in block_ids:
+                if n in rows:
+                    values[n] = (rows[n], key(rows[n]))
+                elif call_failed([responses[j] for j in ids]):
+                    values[n] = (None, None)
+                else:
+                    retry.append(n)
+        pending = retry
+        if not pending:
+            return values
+        time.sleep(attempt + 1)
+
+    raise ValueError(f"no value at {len(pending)} blocks after {tries} tries, first {pending[0]}")
+
+def changepoints(f, contract, abi, eth_rpc_url, start_block, stop_block, interval=6600, key=None,
+                 batch_size=100, session=None, cache=None, tries=3):
+    """
+    Exact history of a step-wise contract value as run-length rows.
+
+    Samples every `interval` blocks, then bisects every pair of consecutive samples
+    whose values differ down to the block where the value changes. All open
+    intervals are bisected together, one batch of calls per round, so an exact
+    history costs about changes * log2(interval) calls and log2(interval) rounds
+    instead of one call per block.
+
+    A value that changes and changes back between two samples is missed, so
+    `interval` must be shorter than the time a value holds, ie. the FSM update delay.
+
+    Parameters
+    ----------
+    f : function
+        worker function of `mp.BATCH_CALLS`, ie. fetch_fsm
+    start_block : int
+    stop_block : int
+    interval : int
+        Blocks between the initial samples
+    key : function
+        Value of a result row compared between blocks, the row without its block by
+        default. ie. `lambda r: r[1]` to ignore the FSM next result.
+    batch_size : int
+        Blocks per JSON-RPC batch request
+    cache : cache.CallCache
+        Cache of fetched return data, blocks are looked up before fetching and final
+        ones stored
+    tries : int
+        Attempts at a block failing for other reasons than a failed call, see
+        `fetch_values`
+    Returns
+    -------
+    list[tuple]
+        Result rows of `f` at `start_block` and at every block where the value changes.
+        Blocks where the call fails, ie. before deployment, have no rows, so the first
+        row after them is the first block the call succeeds.
+    """
+    key = key or (lambda row: row[1:])
+    session = session or requests.Session()
+    if cache:
+        cache.finalized_block = Web3(provider(eth_rpc_url)).eth.block_number - FINALITY_DEPTH
+
+    blocks = sorted(set(range(start_block, stop_block + 1, interval)) | {stop_block})
+    samples = fetch_values(f, contract, abi, eth_rpc_url, blocks, key, batch_size, session, cache, tries)
+    open_intervals = [(lo, hi) for lo, hi in zip(blocks[:-1], blocks[1:]) if samples[lo][1] != samples[hi][1]]
+
+    while open_intervals:
+        mids = [(lo + hi) // 2 for lo, hi in open_intervals if hi - lo > 1]
+        samples.update(fetch_values(f, contract, abi, eth_rpc_url, mids, key, batch_size, session, cache, tries))
+
+        intervals = []
+        for lo, hi in open_intervals:
+            if hi - lo == 1:
+                continue
+            mid = (lo + hi) // 2
+            # a mid value matching neither end means more than one change, keep both halves
+            if samples[mid][1] != samples[lo][1]:
+                intervals.append((lo, mid))
+            if samples[mid][1] != samples[hi][1]:
+                intervals.append((mid, hi))
+        open_intervals = intervals
+
+    runs = []
+    last_value = None
+    for n in sorted(samples):
+        row, value = samples[n]
+        if n == start_block or value != last_value:
+            if row is not None:
+                runs.append(row)
+            last_value = value
+
+    return runs
+
+def expand(runs, blocks):
+    """
+    Rows of run-length `runs` at each of `blocks`, as sampling every block would give.
+    Blocks before the first run are dropped.
+    """
+    first_blocks = np.array([row[0] for row in runs])
+    idx = np.searchsorted(first_blocks, blocks, side='right') - 1
+    return [(n,) + tuple(runs[i][1:]) for n, i in zip(blocks, idx) if i >= 0]
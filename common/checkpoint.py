@@ -0,0 +1,190 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import requests
+
+from mp import fetch, BATCH_CALLS, encode_calls, build_batch, post_batch, decode_batch, call_failed
+from metrics import METRICS
+
+MANIFEST = 'manifest.json'
+
+def job_id(f, contract, blocks, chunk_size):
+    # identifies a sweep so a checkpoint directory is never resumed with other parameters
+    h = hashlib.sha256(json.dumps([f.__name__, contract.lower(), chunk_size, blocks]).encode())
+    return h.hexdigest()
+
+def write_atomic(path, data, compress=False):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fp:
+        fp.write(gzip.compress(data) if compress else data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, path)
+
+def read_manifest(out_dir):
+    path = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fp:
+        return json.load(fp)
+
+def fetch_blocks(f, contract, abi, eth_rpc_url, blocks, tries=3, delay=1, batch_size=100, cache=None):
+    """
+    Fetch `blocks` in batches, retrying only the blocks that may succeed next time.
+
+    A block whose calls ran and failed, ie. reverted before the contract was
+    deployed, or that is cached as failed, fails for good and is not fetched again.
+    Blocks lost to node or network errors, ie. a rate limit or a timed out batch, are
+    fetched again up to `tries` times, sleeping `delay` secs more after each round.
+
+    Returns
+    -------
+    tuple
+        (results, failed, unresolved): results as `f` puts them on its queue, the
+        blocks that failed for good, and those still lost to errors after `tries`
+    """
+    fn_names, build_row = BATCH_CALLS[f]
+    calls = encode_calls(abi, fn_names)
+    failed = []
+    pending = list(blocks)
+    if cache and pending:
+        cached_failures = [cache.failed(contract, calldata, pending) for calldata, _ in calls]
+        failed = [n for n in pending if any(n in x for x in cached_failures)]
+        pending = [n for n in pending if not any(n in x for x in cached_failures)]
+
+    session = requests.Session()
+    results = []
+    error = None
+    for attempt in range(tries):
+        retry = []
+        for i in range(0, len(pending), batch_size):
+            chunk = pending[i:i + batch_size]
+            payload, block_ids = build_batch(contract, calls, chunk)
+            try:
+                responses = post_batch(session, eth_rpc_url, payload)
+            except Exception as e:
+                error = e
+                retry.extend(chunk)
+                continue
+            rows = {row[0]: row for row in decode_batch(calls, build_row, block_ids, responses, contract, cache)}
+            for n, ids in block_ids:
+                if n in rows:
+                    results.append(rows[n])
+                elif call_failed([responses[j] for j in ids]):
+                    failed.append(n)
+                else:
+                    error = [responses[j].get('error') for j in ids]
+                    retry.append(n)
+        pending = retry
+        if not pending or attempt == tries - 1:
+            break
+        METRICS.count('rpc_retries_total', len(pending), source='fetch_blocks')
+        time.sleep(delay * (attempt + 1))
+
+    if pending:
+        METRICS.skip(pending, error, 'fetch_blocks')
+    return results, failed, pending
+
+def retry_blocks(f, contract, abi, eth_rpc_url, blocks, tries, delay, cache=None):
+    """
+    Fetch the `blocks` missing from a sweep again, see `fetch_blocks`.
+    Returns the results and the blocks that still failed.
+    """
+    results, failed, unresolved = fetch_blocks(f, contract, abi, eth_rpc_url, blocks, tries, delay, cache=cache)
+    return results, sorted(failed + unresolved)
+
+def fetch_checkpointed(f, n_jobs, contract, abi, eth_rpc_url, out_dir, blocks, chunk_size=10000,
+                       batch_size=100, engine='process', tries=3, delay=1, cache=None):
+    """
+    Crash-safe, resumable version of `fetch`.
+
+    `blocks` are swept in chunks of `chunk_size`. Each completed chunk is written to
+    `out_dir` as its own part file and committed to a manifest, so a killed sweep
+    loses at most one chunk. Rerunning the same sweep skips committed chunks.
+
+    Blocks missing from a chunk's results are fetched again on their own instead of
+    replaying the chunk, and only retried when they were lost to node or network
+    errors, see `fetch_blocks`. Blocks that still fail are recorded in the manifest
+    under `failed_blocks`.
+
+    Parameters
+    ----------
+    f : function
+        worker function in `BATCH_CALLS`, ie. fetch_rp
+    out_dir : str
+        directory for part files and the manifest
+    blocks : list[int]
+        Block numbers to fetch
+    chunk_size : int
+        Number of blocks per committed part
+    tries : int
+        Attempts per block lost to node or network errors
+    Returns
+    -------
+    list[tuple]
+        All results of the sweep sorted by block, as returned by `fetch`
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    blocks = list(blocks)
+    job = job_id(f, contract, blocks, chunk_size)
+
+    manifest = read_manifest(out_dir)
+    if manifest is None:
+        manifest = {'job': job, 'worker': f.__name__, 'contract': contract, 'n_blocks': len(blocks),
+                    'chunk_size': chunk_size, 'parts': []}
+    elif manifest['job'] != job:
+        raise ValueError(f"{out_dir} holds a checkpoint of a different sweep")
+
+    done = {part['first_block'] for part in manifest['parts']}
+    for i in range(0, len(blocks), chunk_size):
+        chunk = blocks[i:i + chunk_size]
+        if chunk[0] in done:
+            continue
+
+        start = time.time()
+        results = fetch(f, n_jobs, contract, abi, eth_rpc_url, blocks=chunk, batch_size=batch_size,
+                        engine=engine, cache=cache)
+
+        fetched = {r[0] for r in results}
+        missing = [n for n in chunk if n not in fetched]
+        retried, failed = retry_blocks(f, contract, abi, eth_rpc_url, missing, tries, delay, cache)
+        results = sorted(results + retried, key=lambda x: x[0])
+
+        file_name = f"part_{chunk[0]}_{chunk[-1]}.jsonl.gz"
+        write_atomic(os.path.join(out_dir, file_name),
+                     ''.join(json.dumps(r) + '\n' for r in results).encode(), compress=True)
+
+        manifest['parts'].append({'first_block': chunk[0], 'last_block': chunk[-1], 'file': file_name,
+                                  'n_results': len(results), 'failed_blocks': failed})
+        write_atomic(os.path.join(out_dir, MANIFEST), json.dumps(manifest, indent=1).encode())
+
+        print(f"committed blocks {chunk[0]}-{chunk[-1]}, {len(failed)} failed, took {time.time() - start:.1f}")
+
+    return load_checkpoint(out_dir)
+
+def load_checkpoint(out_dir):
+    """
+    Returns the results of all committed parts in `out_dir`, sorted by block
+    """
+    manifest = read_manifest(out_dir)
+    if manifest is None:
+        return []
+
+    results = []
+    for part in manifest['parts']:
+        with gzip.open(os.path.join(out_dir, part['file']), 'rt') as fp:
+            results.extend(tuple(json.loads(line)) for line in fp)
+
+    return sorted(results, key=lambda x: x[0])
+
+def failed_blocks(out_dir):
+    """
+    Returns the blocks that could not be fetched in `out_dir`'s sweep
+    """
+    manifest = read_manifest(out_dir)
+    if manifest is None:
+        return []
+
+    return sorted(n for part in manifest['parts'] for n in part['failed_blocks'])
@@ -0,0 +1,216 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Upper bounds in secs of the latency histogram buckets, the Prometheus defaults
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _labels(key):
+    return ','.join(f'{k}="{v}"' for k, v in key[1])
+
+def _errors(name):
+    # counter of the exceptions raised in timer `name`, ie. rpc_seconds -> rpc_errors_total
+    return name.removesuffix('_seconds') + '_errors_total'
+
+def _series(name, labels):
+    # Prometheus series name, without braces when there are no labels
+    return f'{name}{{{labels}}}' if labels else name
+
+class Metrics():
+    """
+    Call counts, latency histograms, bytes transferred and skipped blocks of the
+    fetch and subgraph paths.
+
+    Counters and histograms are plain dicts keyed by metric name and labels, so a
+    `snapshot` can be put on a multiprocessing.Queue by a worker process and
+    `merge`d into the parent's metrics. Histograms use fixed `BUCKETS` and merge by
+    adding bucket counts.
+
+    Names follow the Prometheus conventions: counters end in `_total` and
+    histograms of durations in `_seconds`.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # a new lock, a forked worker may inherit one held by another thread
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.skipped = []
+        self.start = time.time()
+
+    def count(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            h = self.histograms.setdefault(key, {'buckets': [0] * len(BUCKETS), 'sum': 0., 'count': 0, 'max': 0.})
+            h['buckets'][np.searchsorted(BUCKETS, value)] += 1
+            h['sum'] += value
+            h['count'] += 1
+            h['max'] = max(h['max'], value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the secs spent in the block in histogram `name`, ie. rpc_seconds,
+        counting exceptions in rpc_errors_total
+        """
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.count(_errors(name), **labels)
+            raise
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def transfer(self, sent, received, **labels):
+        self.count('bytes_sent_total', sent, **labels)
+        self.count('bytes_received_total', received, **labels)
+
+    def skip(self, blocks, error, source):
+        """
+        Record blocks dropped from the results of `source` because of `error`
+        """
+        blocks = list(blocks) if np.iterable(blocks) else [blocks]
+        self.count('skipped_blocks_total', len(blocks), source=source)
+        with self.lock:
+            self.skipped.extend({'block': int(n), 'source': source, 'error': str(error)} for n in blocks)
+
+    def snapshot(self):
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'histograms': {k: {**h, 'buckets': list(h['buckets'])} for k, h in self.histograms.items()},
+                    'skipped': list(self.skipped)}
+
+    def merge(self, snapshot):
+        """
+        Add the counts of a `snapshot`, ie. from a worker process
+        """
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other in snapshot['histograms'].items():
+                h = self.histograms.setdefault(key, {'buckets': [0] * len(BUCKETS), 'sum': 0., 'count': 0, 'max': 0.})
+                h['buckets'] = [a + b for a, b in zip(h['buckets'], other['buckets'])]
+                h['sum'] += other['sum']
+                h['count'] += other['count']
+                h['max'] = max(h['max'], other['max'])
+            self.skipped.extend(snapshot['skipped'])
+
+    def summary(self):
+        """
+        Where the time of a sweep went.
+
+        Returns
+        -------
+        dict
+            elapsed : secs since the last reset
+            counters : pd.DataFrame of every counter by name and labels
+            latency : pd.DataFrame of calls, errors, total, mean, p50, p95 and max secs
+                of every timed call, p50 and p95 as bucket upper bounds
+            throughput : pd.Series of blocks per sec of each fetch worker
+            skipped : pd.DataFrame of skipped blocks with their source and error
+        """
+        snapshot = self.snapshot()
+        counters = pd.DataFrame([{'name': name, 'labels': _labels((name, labels)), 'value': value}
+                                 for (name, labels), value in snapshot['counters'].items()],
+                                columns=['name', 'labels', 'value'])
+
+        def quantile(h, q):
+            i = np.searchsorted(np.cumsum(h['buckets']), q * h['count'])
+            return min(BUCKETS[i], h['max'])
+
+        latency = pd.DataFrame([{
+            'name': name, 'labels': _labels((name, labels)), 'calls': h['count'],
+            'errors': snapshot['counters'].get((_errors(name), labels), 0),
+            'total': h['sum'], 'mean': h['sum'] / h['count'], 'p50': quantile(h, 0.5),
+            'p95': quantile(h, 0.95), 'max': h['max'],
+        } for (name, labels), h in snapshot['histograms'].items()],
+            columns=['name', 'labels', 'calls', 'errors', 'total', 'mean', 'p50', 'p95', 'max'])
+
+        blocks = {dict(l)['worker']: v for (name, l), v in snapshot['counters'].items() if name == 'blocks_total'}
+        secs = {dict(l)['worker']: h['sum'] for (name, l), h in snapshot['histograms'].items() if name == 'fetch_seconds'}
+        throughput = pd.Series({w: blocks[w] / secs[w] for w in blocks if secs.get(w)}, name='blocks_per_sec',
+                               dtype=float)
+
+        return {
+            'elapsed': time.time() - self.start,
+            'counters': counters.sort_values(['name', 'labels']).reset_index(drop=True),
+            'latency': latency.sort_values('total', ascending=False).reset_index(drop=True),
+            'throughput': throughput,
+            'skipped': pd.DataFrame(snapshot['skipped'], columns=['block', 'source', 'error']),
+        }
+
+    def to_json(self, path=None):
+        """
+        Snapshot as JSON, written to `path` if given
+        """
+        snapshot = self.snapshot()
+        data = json.dumps({
+            'elapsed': time.time() - self.start,
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in snapshot['counters'].items()],
+            'histograms': [{'name': name, 'labels': dict(labels), 'le': [str(b) for b in BUCKETS], **h}
+                           for (name, labels), h in snapshot['histograms'].items()],
+            'skipped': snapshot['skipped'],
+        }, indent=1)
+        if path:
+            with open(path, 'w') as fp:
+                fp.write(data)
+        return data
+
+    def to_prometheus(self, path=None):
+        """
+        Counters and histograms in the Prometheus text format, written to `path` if
+        given, ie. for the node exporter's textfile collector
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name in sorted({name for name, _ in snapshot['counters']}):
+            lines.append(f'# TYPE {name} counter')
+            lines += [f'{_series(name, _labels(k))} {v}' for k, v in snapshot['counters'].items() if k[0] == name]
+        for name in sorted({name for name, _ in snapshot['histograms']}):
+            lines.append(f'# TYPE {name} histogram')
+            for key, h in snapshot['histograms'].items():
+                if key[0] != name:
+                    continue
+                labels = _labels(key)
+                sep = ',' if labels else ''
+                for le, n in zip(BUCKETS, np.cumsum(h['buckets'])):
+                    le = '+Inf' if le == float('inf') else le
+                    lines.append(f'{name}_bucket{{{labels}{sep}le="{le}"}} {n}')
+                lines.append(f'{_series(name + "_sum", labels)} {h["sum"]}')
+                lines.append(f'{_series(name + "_count", labels)} {h["count"]}')
+        data = '\n'.join(lines) + '\n'
+        if path:
+            with open(path, 'w') as fp:
+                fp.write(data)
+        return data
+
+# Metrics of this process, worker processes send theirs back to be merged here
+METRICS = Metrics()
+
+def rpc_methods(payload):
+    # JSON-RPC methods of a request or batch
+    return [x['method'] for x in payload] if isinstance(payload, list) else [payload['method']]
+
+def count_rpc(payload):
+    for method in rpc_methods(payload):
+        METRICS.count('rpc_calls_total', method=method)
+
+def rpc_label(payload):
+    # latency label of a request, batches are timed as a whole
+    return 'batch' if isinstance(payload, list) else payload['method']
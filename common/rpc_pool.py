@@ -0,0 +1,331 @@
+import os
+import re
+import json
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from web3 import HTTPProvider
+from web3.providers.base import JSONBaseProvider
+
+from metrics import METRICS, count_rpc, rpc_label
+
+# JSON-RPC error codes and messages providers use for rate limiting: Infura -32005
+# "request rate limited", QuickNode -32007 "request limit reached", Alchemy 429
+# "exceeded its compute units per second capacity", and plain "too many requests"
+RATE_LIMIT_CODES = (-32005, -32007, -32029, 429)
+RATE_LIMIT_MESSAGES = re.compile(r'rate.?limit|too many requests|request limit reached|exceeded .*capacity'
+                                 r'|request count exceeded|throughput exceeded', re.IGNORECASE)
+
+# Errors of eth_getLogs ranges returning too many logs, Infura also answers these
+# with -32005, so they are not rate limits
+TOO_MANY_RESULTS_MESSAGES = re.compile(r'query returned more than \d+ results|log response size exceeded'
+                                       r'|response size exceeded|block range is too (large|wide)'
+                                       r'|exceed(s|ed) (the )?max(imum)? block range|range too large'
+                                       r'|logs? matched by query exceeds limit', re.IGNORECASE)
+
+def too_many_results(error):
+    """
+    Whether a JSON-RPC error object means an eth_getLogs range should be split
+    """
+    return isinstance(error, dict) and bool(TOO_MANY_RESULTS_MESSAGES.search(str(error.get('message', ''))))
+
+def rate_limited(error):
+    """
+    Whether a JSON-RPC error object is a rate limit, to be retried elsewhere
+    """
+    if not isinstance(error, dict) or too_many_results(error):
+        return False
+    return error.get('code') in RATE_LIMIT_CODES or bool(RATE_LIMIT_MESSAGES.search(str(error.get('message', ''))))
+
+class RPCPoolError(Exception):
+    pass
+
+class Endpoint():
+    """
+    Live latency and error statistics of one JSON-RPC endpoint
+    """
+    def __init__(self, url, window=100, pool_size=16):
+        self.url = url
+        self.session = requests.Session()
+        self.session.mount(url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.latencies = deque(maxlen=window)
+        self.error_rate = 0.
+        self.failures = 0
+        self.backoff_until = 0.
+        self.n_requests = 0
+        self.n_errors = 0
+        self.lock = threading.Lock()
+
+    def latency(self):
+        return np.median(self.latencies) if self.latencies else 0.
+
+    def quantile(self, q):
+        return np.quantile(self.latencies, q) if self.latencies else None
+
+    def score(self, error_penalty=10):
+        # lower is better, endpoints without samples first so every one gets measured
+        return self.latency() * (1 + error_penalty * self.error_rate)
+
+    def success(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.error_rate *= 0.9
+            self.failures = 0
+            self.n_requests += 1
+
+    def failure(self, backoff, max_backoff, retry_after=None):
+        with self.lock:
+            self.error_rate = 0.9 * self.error_rate + 0.1
+            self.failures += 1
+            self.n_requests += 1
+            self.n_errors += 1
+            delay = min(backoff * 2**(self.failures - 1), max_backoff)
+            self.backoff_until = time.monotonic() + max(delay, retry_after or 0)
+
+class RPCPool():
+    """
+    JSON-RPC client spreading requests over several endpoints.
+
+    Each request goes to the endpoint with the lowest median latency, weighted by
+    its recent error rate. When it has not answered after the endpoint's own p95
+    latency, the same request is sent to the next best endpoint and the first
+    answer wins, so one slow or rate-limited node does not set the pace of a sweep.
+    A failed endpoint is backed off exponentially on its own, honouring
+    Retry-After, while the others keep serving.
+
+    An `RPCPool` can be passed wherever an `eth_rpc_url` is expected by `post_batch`
+    and `provider`.
+
+    Parameters
+    ----------
+    urls : list[str]
+        Endpoint urls
+    timeout : float
+        Seconds before a request is abandoned
+    hedge : bool
+        Send a duplicate request to another endpoint when one is slow
+    hedge_quantile : float
+        Latency quantile of the endpoint after which a request is hedged
+    min_hedge_delay : float
+        Seconds, hedge delays are never shorter
+    backoff : float
+        Seconds an endpoint is skipped after its first consecutive failure, doubled
+        with every further one up to `max_backoff`
+    tries : int
+        Failed attempts over all endpoints before a request raises `RPCPoolError`,
+        3 per endpoint by default
+    n_workers : int
+        Requests in flight, including hedges
+    """
+    def __init__(self, urls, timeout=10, hedge=True, hedge_quantile=0.95, min_hedge_delay=0.05, backoff=1,
+                 max_backoff=60, tries=None, n_workers=16):
+        if isinstance(urls, str):
+            urls = [urls]
+        self.urls = list(urls)
+        self.timeout = timeout
+        self.hedge = hedge and len(self.urls) > 1
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.tries = tries or 3 * len(self.urls)
+        self.n_workers = n_workers
+        self._setup()
+
+    def _setup(self):
+        self.pid = os.getpid()
+        self.endpoints = [Endpoint(url, pool_size=self.n_workers) for url in self.urls]
+        self.executor = ThreadPoolExecutor(self.n_workers)
+        self.n_hedged = 0
+        self.n_hedge_wins = 0
+
+    # sessions, locks and threads are not picklable and worker threads do not survive
+    # a fork, a pool sent or forked to another process starts afresh
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k not in ('endpoints', 'executor')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup()
+
+    def close(self):
+        """
+        Stop the worker threads, cancelling queued requests, and close the endpoints'
+        connections
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for endpoint in self.endpoints:
+            endpoint.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def pick(self, exclude=(), ready_only=False):
+        """
+        Best endpoint not in `exclude` and not backed off, or the one whose backoff
+        ends first. None when all are excluded.
+        """
+        now = time.monotonic()
+        candidates = [ep for ep in self.endpoints if ep not in exclude]
+        ready = [ep for ep in candidates if ep.backoff_until <= now]
+        if ready:
+            return min(ready, key=lambda ep: ep.score())
+        if candidates and not ready_only:
+            return min(candidates, key=lambda ep: ep.backoff_until)
+        return None
+
+    def hedge_delay(self, endpoint):
+        q = endpoint.quantile(self.hedge_quantile)
+        delay = self.timeout / 4 if q is None or len(endpoint.latencies) < 10 else q
+        return min(max(delay, self.min_hedge_delay), self.timeout)
+
+    def send(self, endpoint, payload):
+        """
+        Post `payload` to one endpoint and record the outcome
+        """
+        # an endpoint still backing off is only used when all others are too
+        wait_for = endpoint.backoff_until - time.monotonic()
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+        data = json.dumps(payload)
+        start = time.monotonic()
+        retry_after = None
+        try:
+            r = endpoint.session.post(endpoint.url, data=data, headers={'Content-Type': 'application/json'},
+                                      timeout=self.timeout)
+            METRICS.transfer(len(data), len(r.content), endpoint=endpoint.url)
+            if r.status_code == 429 and r.headers.get('Retry-After', '').isdigit():
+                retry_after = float(r.headers['Retry-After'])
+            r.raise_for_status()
+            result = r.json()
+            if isinstance(payload, list) and isinstance(result, dict):
+                # some providers answer a rejected batch with a single error object
+                raise ValueError(f"batch request failed: {result.get('error')}")
+            # a 200 batch can hold rate limit errors for some of its calls
+            for item in result if isinstance(result, list) else [result]:
+                if isinstance(item, dict) and rate_limited(item.get('error')):
+                    raise ValueError(f"rate limited: {item['error']}")
+        except (requests.RequestException, ValueError):
+            endpoint.failure(self.backoff, self.max_backoff, retry_after)
+            METRICS.count('rpc_failures_total', endpoint=endpoint.url)
+            raise
+
+        endpoint.success(time.monotonic() - start)
+        return result
+
+    def post(self, payload):
+        """
+        Send a JSON-RPC request or batch and return the decoded response of the
+        first endpoint answering it
+        """
+        if self.pid != os.getpid():
+            self._setup()
+        count_rpc(payload)
+        with METRICS.timer('rpc_seconds', method=rpc_label(payload)):
+            return self._post(payload)
+
+    def _post(self, payload):
+        pending = {}
+        hedges = set()
+        tried = set()
+        errors = []
+
+        while True:
+            if not pending:
+                if len(errors) >= self.tries:
+                    raise RPCPoolError(f"{len(errors)} failed attempts, last: {errors[-1]}") from errors[-1]
+                endpoint = self.pick(tried)
+                if endpoint is None:
+                    # every endpoint failed this request once, start another round
+                    tried = set()
+                    endpoint = self.pick()
+                if errors:
+                    METRICS.count('rpc_retries_total')
+                tried.add(endpoint)
+                pending[self.executor.submit(self.send, endpoint, payload)] = endpoint
+
+            hedge_to = self.pick(tried, ready_only=True) if self.hedge else None
+            delay = self.hedge_delay(endpoint) if hedge_to else None
+            done, _ = wait(pending, timeout=delay, return_when=FIRST_COMPLETED)
+
+            if not done:
+                endpoint = hedge_to
+                tried.add(endpoint)
+                future = self.executor.submit(self.send, endpoint, payload)
+                pending[future] = endpoint
+                hedges.add(future)
+                self.n_hedged += 1
+                METRICS.count('rpc_hedges_total')
+                continue
+
+            for future in done:
+                pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                if future in hedges:
+                    self.n_hedge_wins += 1
+                return result
+
+    def stats(self):
+        """
+        Requests, errors, latency quantiles and backoff of every endpoint
+        """
+        now = time.monotonic()
+        return pd.DataFrame([{
+            'url': ep.url,
+            'requests': ep.n_requests,
+            'errors': ep.n_errors,
+            'error_rate': ep.error_rate,
+            'p50': ep.quantile(0.5),
+            'p95': ep.quantile(0.95),
+            'backoff': max(ep.backoff_until - now, 0),
+        } for ep in self.endpoints]).set_index('url')
+
+class MeteredHTTPProvider(HTTPProvider):
+    """
+    HTTPProvider counting calls and timing them per JSON-RPC method in `METRICS`
+    """
+    def make_request(self, method, params):
+        METRICS.count('rpc_calls_total', method=method)
+        with METRICS.timer('rpc_seconds', method=method):
+            return super().make_request(method, params)
+
+class PoolProvider(JSONBaseProvider):
+    """
+    web3 provider sending its requests through an `RPCPool`
+    """
+    def __init__(self, pool, **kwargs):
+        super().__init__(**kwargs)
+        self.pool = pool
+
+    def make_request(self, method, params):
+        return self.pool.post({'jsonrpc': '2.0', 'method': method, 'params': params or [],
+                               'id': next(self.request_counter)})
+
+    def make_batch_request(self, batch_requests):
+        payload = [{'jsonrpc': '2.0', 'method': method, 'params': params or [], 'id': next(self.request_counter)}
+                   for method, params in batch_requests]
+        return sorted(self.pool.post(payload), key=lambda x: x['id'])
+
+def provider(eth_rpc_url, timeout=10):
+    """
+    web3 provider of `eth_rpc_url`: a url, a list of urls or an `RPCPool`
+    """
+    if isinstance(eth_rpc_url, RPCPool):
+        return PoolProvider(eth_rpc_url)
+    if isinstance(eth_rpc_url, (list, tuple)):
+        return PoolProvider(RPCPool(eth_rpc_url, timeout))
+    return MeteredHTTPProvider(eth_rpc_url, request_kwargs={"timeout": timeout})
@@ -0,0 +1,289 @@
+import time
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+from rai import WAD, RAY, RaiFixed, replay_terms
+from rates import SECONDS_PER_YEAR
+from monitoring import STORE_DIR, load
+
+# Per-second rate bounds of the calculator, as rates - RAY over RAY
+RATE_LOWER_BOUND = (999999934241503702775225172 - 10**27) / RAY
+RATE_UPPER_BOUND = (1000000065758500621404894451 - 10**27) / RAY
+
+SCORES = ['tracking_error', 'rate_volatility', 'time_at_bound', 'rate_rmse']
+
+def load_history(store_dir=STORE_DIR, first_block=15046690, last_block=None):
+    """
+    Rate updates of the scaled calculator from the monitoring event store as float arrays.
+
+    The first update is the starting state of every replay: its redemption price,
+    rate and controller terms. Prices are USD, rates and terms are relative to RAY.
+    kp, ki and alpha are the gains in force after each update, they were changed by
+    governance at blocks 16656455 and 20975297, see `gain_segments`. The RAY prices,
+    rates and alphas are also kept as exact ints for `replay_fixed`, with the exact
+    terms of `rai.replay_terms` where the store only has float ones.
+    """
+    df = load(store_dir)
+    terms = {i: (prop_term, integral_term) for i, prop_term, integral_term, _ in replay_terms(df.to_dict('records'))}
+    blocks = df['blockNumber'].astype(int)
+    df = df[(blocks >= first_block) & (blocks <= (last_block or blocks.max()))]
+    terms = [terms.get(i, (int(row['prop_term']), int(row['integral_term']))) for i, row in df.iterrows()]
+    df = df.reset_index(drop=True)
+
+    return {
+        'block': df['blockNumber'].astype(int).values,
+        'ts': df['ts'].astype(int).values,
+        'market_price': np.array([float(x) for x in df['marketPrice']]) / RAY,
+        'redemption_price': np.array([float(x) for x in df['redemptionPrice']]) / RAY,
+        'redemption_rate': np.array([float(int(x) - 10**27) for x in df['redemptionRate']]) / RAY,
+        'prop_term': df['prop_term'].astype(float).values / RAY,
+        'integral_term': df['integral_term'].astype(float).values / RAY,
+        'kp': df['sg'].astype(float).values,
+        'ki': df['ag'].astype(float).values,
+        'alpha': df['pscl'].astype(float).values,
+        # exact RAY values of `replay_fixed`, alpha as a float is off by up to 1e11
+        'market_price_ray': np.array([int(x) for x in df['marketPrice']], dtype=object),
+        'redemption_price_ray': np.array([int(x) for x in df['redemptionPrice']], dtype=object),
+        'redemption_rate_ray': np.array([int(x) for x in df['redemptionRate']], dtype=object),
+        'prop_term_ray': np.array([t[0] for t in terms], dtype=object),
+        'integral_term_ray': np.array([t[1] for t in terms], dtype=object),
+        'pscl': np.array([int(x) for x in df['pscl']], dtype=object),
+    }
+
+def gain_segments(history):
+    """
+    Split `history` where the deployed gains change.
+
+    Each segment starts from the last update before the change, its starting state,
+    and holds the updates computed with the new gains, so the deployed gains of a
+    segment replay it. Updates of one segment have the same kp, ki and alpha from the
+    second on.
+
+    Returns
+    -------
+    list[dict]
+        Histories as `load_history`
+    """
+    gains = np.stack([history['kp'], history['ki'], history['alpha']], axis=1)
+    changes = np.flatnonzero((gains[2:] != gains[1:-1]).any(axis=1)) + 2
+    bounds = [0, *(changes - 1), len(gains) - 1]
+    return [{k: v[start:end + 1] for k, v in history.items()} for start, end in zip(bounds[:-1], bounds[1:])]
+
+def apy(rate):
+    # annual percent of per-second rates relative to RAY
+    return np.expm1(SECONDS_PER_YEAR * np.log1p(rate)) * 100
+
+def replay(history, kp, ki, alpha, noise_barrier=WAD):
+    """
+    Replay the market prices of `history` through the scaled PI calculator for many
+    candidates at once and score each one.
+
+    Every candidate starts from the state of the first update. The redemption price
+    then follows the candidate's own rates, while market prices are historical, as
+    in `RaiFixed.process`. State is one float array over candidates, so an update costs
+    a few array operations whatever the number of candidates, and scores are
+    accumulated on the fly.
+
+    Replay a segment of `gain_segments`: across a governance change no single
+    candidate matches the historical rates. With the deployed gains of a segment
+    rate_rmse is below ~1e-6 APY percentage points, 7e-8 over the 465 updates of
+    the first one, while the whole scaled history gives ~75.
+
+    Parameters
+    ----------
+    history : dict
+        See `load_history`
+    kp : array-like
+        Proportional gains, WAD as `Rai`
+    ki : array-like
+        Integral gains, WAD
+    alpha : array-like
+        Per-second integral leak, RAY
+    noise_barrier : float
+        WAD
+    Returns
+    -------
+    pd.DataFrame
+        kp, ki, alpha and the `SCORES` of each candidate:
+        tracking_error is the time weighted RMS of (redemption - market) / redemption,
+        rate_volatility the std of the APY change between updates in percentage points,
+        time_at_bound the share of time the rate sits at a bound and rate_rmse the RMS
+        difference in APY percentage points to the historical rates
+    """
+    kp, ki, alpha = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (kp, ki, alpha)))
+    kp, ki = kp / WAD, ki / WAD
+    log_alpha = np.log(alpha / RAY)
+    noise = 1 - noise_barrier / WAD
+
+    ts = history['ts']
+    market_price = history['market_price']
+    hist_apy = apy(history['redemption_rate'])
+
+    rp = np.full(kp.shape, history['redemption_price'][0])
+    rate = np.full(kp.shape, history['redemption_rate'][0])
+    prop_term = np.full(kp.shape, history['prop_term'][0])
+    integral_term = np.full(kp.shape, history['integral_term'][0])
+    last_apy = apy(rate)
+
+    tracking = np.zeros(kp.shape)
+    rate_changes = []
+    at_bound = np.zeros(kp.shape)
+    rate_sq_error = np.zeros(kp.shape)
+
+    for i in range(1, len(ts)):
+        dt = ts[i] - ts[i - 1]
+        # time at the rate set by the previous update
+        at_bound += dt * ((rate <= RATE_LOWER_BOUND) | (rate >= RATE_UPPER_BOUND))
+
+        rp = rp * np.exp(dt * np.log1p(rate))
+        error = (rp - market_price[i]) / rp
+        integral_term = np.exp(dt * log_alpha) * integral_term + (error + prop_term) / 2 * dt
+        prop_term = error
+
+        pi_output = kp * error + ki * integral_term
+        rate = np.clip(pi_output, RATE_LOWER_BOUND, RATE_UPPER_BOUND)
+        rate = np.where((pi_output == 0) | (np.abs(pi_output) < rp * noise), 0, rate)
+
+        tracking += dt * error**2
+        new_apy = apy(rate)
+        rate_changes.append(new_apy - last_apy)
+        last_apy = new_apy
+        rate_sq_error += (new_apy - hist_apy[i])**2
+
+    duration = ts[-1] - ts[0]
+    n_updates = len(ts) - 1
+    return pd.DataFrame({
+        'kp': kp.ravel() * WAD, 'ki': ki.ravel() * WAD, 'alpha': alpha.ravel(),
+        'tracking_error': np.sqrt(tracking / duration).ravel(),
+        'rate_volatility': np.std(rate_changes, axis=0).ravel(),
+        'time_at_bound': (at_bound / duration).ravel(),
+        'rate_rmse': np.sqrt(rate_sq_error / n_updates).ravel(),
+    })
+
+def replay_fixed(history, kp=None, ki=None, alpha=None, check=True):
+    """
+    Redemption rates of one candidate replayed with the exact integer `RaiFixed`, as
+    a reference for `replay`. Rates are relative to RAY.
+
+    Without gains, every update uses the gains deployed at its block and the event's
+    redemption price, so the whole history replays across governance changes to the
+    recorded rates. With `check`, raise a ValueError on any rate differing from them.
+    """
+    deployed = kp is None
+    if deployed:
+        kp, ki, alpha = history['kp'][1], history['ki'][1], history['pscl'][1]
+    rai = RaiFixed(0, history['redemption_rate_ray'][0], history['ts'][0], int(kp), int(ki), int(alpha),
+                   history['prop_term_ray'][0], history['integral_term_ray'][0])
+    rai.redemption_price_ray = history['redemption_price_ray'][0]
+    rates = []
+    for i in range(1, len(history['ts'])):
+        time_since = int(history['ts'][i]) - rai.last_update_time
+        if deployed:
+            if history['pscl'][i] != rai.alpha:
+                rai.alpha = history['pscl'][i]
+                rai.leak_table = {}
+            rai.kp, rai.ki = int(history['kp'][i]), int(history['ki'][i])
+            rai.redemption_price_ray = history['redemption_price_ray'][i]
+        else:
+            rai.update_rp(time_since)
+        rai.redemption_rate = rai.compute_rate(history['market_price_ray'][i], time_since)
+        rai.last_update_time = int(history['ts'][i])
+
+        if check and deployed and rai.redemption_rate != history['redemption_rate_ray'][i]:
+            raise ValueError(f"update at block {history['block'][i]} does not replay, rate differs by "
+                             f"{rai.redemption_rate - history['redemption_rate_ray'][i]}")
+        rates.append((rai.redemption_rate - 10**27) / RAY)
+    return np.array(rates)
+
+# history of the worker processes, set by `init_worker`
+_worker = {}
+
+def init_worker(history):
+    _worker['history'] = history
+
+def replay_chunk(args):
+    return replay(_worker['history'], *args)
+
+def evaluate(history, kp, ki, alpha, n_jobs=None, chunk_size=2000):
+    """
+    `replay` of candidates split in chunks over `n_jobs` processes
+    """
+    kp, ki, alpha = [np.ravel(x) for x in np.broadcast_arrays(kp, ki, alpha)]
+    chunks = [(kp[i:i + chunk_size], ki[i:i + chunk_size], alpha[i:i + chunk_size])
+              for i in range(0, len(kp), chunk_size)]
+    if n_jobs == 1 or len(chunks) == 1:
+        return pd.concat([replay(history, *c) for c in chunks], ignore_index=True)
+
+    ctx = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    with ctx.Pool(n_jobs, initializer=init_worker, initargs=(history,)) as pool:
+        return pd.concat(pool.map(replay_chunk, chunks), ignore_index=True)
+
+def grid_search(history, kps, kis, alphas, n_jobs=None):
+    """
+    Scores of every (kp, ki, alpha) combination of the given values
+    """
+    kp, ki, alpha = np.meshgrid(kps, kis, alphas, indexing='ij')
+    start = time.time()
+    results = evaluate(history, kp, ki, alpha, n_jobs)
+    print(f"{len(results)} candidates in {time.time() - start:.1f}s")
+    return results
+
+def objective(results, weights=None):
+    """
+    Weighted sum of scores, lower is better. Default weights favour tracking and
+    penalize rate volatility and time at bound.
+    """
+    weights = weights or {'tracking_error': 1, 'rate_volatility': 0.01, 'time_at_bound': 0.1}
+    return sum(w * results[name] for name, w in weights.items())
+
+def cem_search(history, bounds, weights=None, n_candidates=2000, n_elite=100, n_iter=10, seed=0, n_jobs=None):
+    """
+    Gradient-free search of gains minimizing `objective` with the cross-entropy method.
+
+    Candidates are drawn from a normal distribution over log10 of each parameter,
+    which is refit to the `n_elite` best of every iteration, so each iteration is one
+    batched `evaluate` call.
+
+    Parameters
+    ----------
+    bounds : dict
+        {'kp': (low, high), 'ki': (low, high), 'alpha': (low, high)}, alpha is the
+        per-second leak in RAY and searched as log10 of 1 - alpha/RAY
+    weights : dict
+        Score weights of `objective`
+    Returns
+    -------
+    pd.DataFrame
+        All evaluated candidates with their objective and iteration, best first
+    """
+    rng = np.random.default_rng(seed)
+
+    def to_x(name, v):
+        return np.log10(1 - np.asarray(v) / RAY) if name == 'alpha' else np.log10(v)
+
+    def from_x(name, x):
+        return (1 - 10**x) * RAY if name == 'alpha' else 10**x
+
+    names = ['kp', 'ki', 'alpha']
+    lows = np.array([min(to_x(n, bounds[n][0]), to_x(n, bounds[n][1])) for n in names])
+    highs = np.array([max(to_x(n, bounds[n][0]), to_x(n, bounds[n][1])) for n in names])
+    mean = (lows + highs) / 2
+    std = (highs - lows) / 2
+
+    all_results = []
+    for it in range(n_iter):
+        x = np.clip(rng.normal(mean, std, size=(n_candidates, 3)), lows, highs)
+        results = evaluate(history, *(from_x(n, x[:, j]) for j, n in enumerate(names)), n_jobs=n_jobs)
+        results['objective'] = objective(results, weights)
+        results['iteration'] = it
+        all_results.append(results)
+
+        elite = np.argsort(results['objective'].values)[:n_elite]
+        mean = x[elite].mean(axis=0)
+        std = x[elite].std(axis=0) + 1e-3
+        best = results.iloc[elite[0]]
+        print(f"iteration {it}: best objective {best['objective']:.6g}, kp {best['kp']:.4g}, ki {best['ki']:.4g}, "
+              f"alpha {best['alpha']:.12g}")
+
+    return pd.concat(all_results, ignore_index=True).sort_values('objective').reset_index(drop=True)
@@ -0,0 +1,186 @@
+import json
+import requests
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from eth_abi import decode
+from eth_utils import function_abi_to_4byte_selector, to_checksum_address
+
+from abis.abis import GEB_RRFM_CALCULATOR_ABI
+from monitoring import RAW_COLUMNS
+from rpc_pool import RPCPool, RPCPoolError, too_many_results
+
+# UpdateRedemptionRate(uint256 marketPrice, uint256 redemptionPrice, uint256 redemptionRate)
+UPDATE_RR_TOPIC = '0x16abce12916e67b821a9cdabe7103d806d6f4280a69d5830925b3e34c83f52a8'
+
+GEB_RRFM_SETTER = '0x7Acfc14dBF2decD1c9213Db32AE7784626daEb48'
+
+# Rate calculator in use from each block on
+CALCULATORS = [(14226200, '0xddA334de7A9C57A641616492175ca203Ba8Cf981'),
+               (15046690, '0x5CC4878eA3E6323FdA34b3D28551E1543DEe54C6')]
+
+# Calculator getters read at every update, in RAW_COLUMNS order
+CALCULATOR_GETTERS = ['getLastProportionalTerm', 'getLastIntegralTerm', 'sg', 'ag', 'pscl']
+
+class RPCError(Exception):
+    """
+    A JSON-RPC error answer, with the error object in `error`
+    """
+    def __init__(self, error):
+        super().__init__(error.get('message', error) if isinstance(error, dict) else error)
+        self.error = error
+
+def call(pool, method, params):
+    result = pool.post({'jsonrpc': '2.0', 'id': 0, 'method': method, 'params': params})
+    if 'error' in result:
+        raise RPCError(result['error'])
+    return result['result']
+
+def batch(pool, calls):
+    """
+    Returns the results of [(method, params)] sent as one batch request, in order
+    """
+    if not calls:
+        return []
+    payload = [{'jsonrpc': '2.0', 'id': i, 'method': method, 'params': params}
+               for i, (method, params) in enumerate(calls)]
+    responses = pool.post(payload)
+    if isinstance(responses, dict):
+        # some providers answer a rejected batch with a single error object
+        raise RPCError(responses.get('error'))
+    responses = sorted(responses, key=lambda x: x['id'])
+    errors = [x['error'] for x in responses if 'error' in x]
+    if errors:
+        raise RPCError(errors[0])
+    return [x['result'] for x in responses]
+
+def get_logs(pool, address, topics, first_block, last_block, span=50000, n_workers=8):
+    """
+    All logs of `address` matching `topics` between two blocks.
+
+    The range is split into `span` block chunks fetched concurrently. A chunk the
+    provider refuses for returning too many results or a too wide range, see
+    `rpc_pool.too_many_results`, or does not answer before the client timeout, is
+    split in halves until it goes through, so the same call works on providers with
+    different limits.
+
+    Returns
+    -------
+    list[dict]
+        Raw logs sorted by block and log index
+    """
+    def fetch(start, end):
+        params = [{'fromBlock': hex(start), 'toBlock': hex(end), 'address': address, 'topics': topics}]
+        try:
+            return call(pool, 'eth_getLogs', params)
+        except RPCError as e:
+            if start == end or not too_many_results(e.error):
+                raise
+        except RPCPoolError as e:
+            if start == end or not isinstance(e.__cause__, requests.Timeout):
+                raise
+        mid = (start + end) // 2
+        return fetch(start, mid) + fetch(mid + 1, end)
+
+    chunks = [(start, min(start + span - 1, last_block)) for start in range(first_block, last_block + 1, span)]
+    with ThreadPoolExecutor(n_workers) as executor:
+        logs = [log for chunk_logs in executor.map(lambda c: fetch(*c), chunks) for log in chunk_logs]
+
+    return sorted(logs, key=lambda x: (int(x['blockNumber'], 16), int(x['logIndex'], 16)))
+
+def run_batches(pool, calls, batch_size=100, n_workers=8):
+    # results of `calls` sent in concurrent batches of `batch_size`
+    batches = [calls[i:i + batch_size] for i in range(0, len(calls), batch_size)]
+    with ThreadPoolExecutor(n_workers) as executor:
+        return [result for results in executor.map(lambda b: batch(pool, b), batches) for result in results]
+
+def fetch_timestamps(pool, blocks, batch_size=100, n_workers=8):
+    """
+    Returns {block: timestamp} for `blocks`
+    """
+    blocks = sorted(set(blocks))
+    calls = [('eth_getBlockByNumber', [hex(b), False]) for b in blocks]
+    return {b: int(block['timestamp'], 16) for b, block in zip(blocks, run_batches(pool, calls, batch_size, n_workers))}
+
+def calculator_at(block, calculators=CALCULATORS):
+    address = None
+    for from_block, calc in calculators:
+        if block >= from_block:
+            address = calc
+    return address
+
+def fetch_calculator_state(pool, blocks, calculators=CALCULATORS, batch_size=100, n_workers=8):
+    """
+    Returns {block: (prop_term, integral_term, sg, ag, pscl)} of the calculator in
+    use at each of `blocks`, read at that block
+    """
+    fn_abis = {x['name']: x for x in json.loads(GEB_RRFM_CALCULATOR_ABI) if x.get('type') == 'function'}
+    getters = [('0x' + function_abi_to_4byte_selector(fn_abis[name]).hex(), [o['type'] for o in fn_abis[name]['outputs']])
+               for name in CALCULATOR_GETTERS]
+
+    blocks = sorted(set(blocks))
+    calls = [('eth_call', [{'to': calculator_at(b, calculators), 'data': selector}, hex(b)])
+             for b in blocks for selector, _ in getters]
+    results = run_batches(pool, calls, batch_size, n_workers)
+
+    state = {}
+    for i, b in enumerate(blocks):
+        outputs = results[i * len(getters):(i + 1) * len(getters)]
+        state[b] = tuple(decode(types, bytes.fromhex(out[2:]))[0] for out, (_, types) in zip(outputs, getters))
+    return state
+
+def gather_data(eth_rpc_url, first_block, last_block='latest', setter=GEB_RRFM_SETTER, calculators=CALCULATORS,
+                span=50000, batch_size=100, n_workers=8, timeout=30):
+    """
+    Collect UpdateRedemptionRate events with block timestamps and rate calculator state.
+
+    Logs are fetched in adaptive block ranges, then the timestamps and the five
+    calculator getters of every event block are read with concurrent JSON-RPC batch
+    requests, instead of a `get_block` and five `eth_call`s per event in sequence.
+
+    Parameters
+    ----------
+    eth_rpc_url : str, list[str] or rpc_pool.RPCPool
+        Archive node url, or several
+    first_block : int
+    last_block : int or str
+        Last block included, or 'latest'
+    setter : str
+        Rate setter address emitting the events
+    calculators : list[tuple]
+        (from_block, address) of each rate calculator, sorted by block
+    span : int
+        Initial block range of getLogs requests
+    batch_size : int
+        Calls per batch request
+    n_workers : int
+        Concurrent requests
+    timeout : float
+        Seconds before a request is abandoned, when `eth_rpc_url` is not an `RPCPool`
+    Returns
+    -------
+    pd.DataFrame
+        Events with `RAW_COLUMNS`
+    """
+    own_pool = not isinstance(eth_rpc_url, RPCPool)
+    pool = RPCPool(eth_rpc_url, timeout) if own_pool else eth_rpc_url
+    try:
+        if last_block == 'latest':
+            last_block = int(call(pool, 'eth_blockNumber', []), 16)
+        if first_block > last_block:
+            return pd.DataFrame(columns=RAW_COLUMNS)
+
+        logs = get_logs(pool, setter, [UPDATE_RR_TOPIC], first_block, last_block, span, n_workers)
+        blocks = [int(log['blockNumber'], 16) for log in logs]
+        timestamps = fetch_timestamps(pool, blocks, batch_size, n_workers)
+        state = fetch_calculator_state(pool, blocks, calculators, batch_size, n_workers)
+    finally:
+        if own_pool:
+            pool.close()
+
+    results = []
+    for log, block in zip(logs, blocks):
+        market_price, redemption_price, redemption_rate = decode(['uint256'] * 3, bytes.fromhex(log['data'][2:]))
+        results.append([market_price, redemption_price, redemption_rate, log['transactionHash'],
+                        to_checksum_address(log['address']), block, timestamps[block], *state[block]])
+
+    return pd.DataFrame(results, columns=RAW_COLUMNS)
@@ -0,0 +1,164 @@
+import os
+import gzip
+import json
+import pandas as pd
+
+from rates import rate_apy
+
+# Columns of UpdateRedemptionRate events as collected by `gather_data`
+RAW_COLUMNS = ['marketPrice', 'redemptionPrice', 'redemptionRate', 'transactionHash', 'address',
+               'blockNumber', 'ts', 'prop_term', 'integral_term', 'sg', 'ag', 'pscl']
+
+# RAY and WAD integers of the events, read back as python ints. Rows written before
+# the store kept them exact hold the terms as floats.
+INT_COLUMNS = ['marketPrice', 'redemptionPrice', 'redemptionRate', 'prop_term', 'integral_term', 'sg', 'ag', 'pscl']
+
+MANIFEST = 'manifest.json'
+
+# Event store of the monitoring notebook, the history read by calibrate, rates and rai
+STORE_DIR = 'output/events'
+
+def write_atomic(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, path)
+
+def derive(df):
+    """
+    Add the rate and APY columns of the monitoring charts to events `df`.
+    Only uses values of the same row, so it can be run on new events alone. The
+    event columns are left as they are, the added ones are floats.
+    """
+    df = df.copy()
+    prop_term = df['prop_term'].astype(float)
+    integral_term = df['integral_term'].astype(float)
+
+    # these are delta rates, not per-second rates
+    df['p_rate_delta'] = (prop_term * df['sg'].astype(float))/1e18
+    df['i_rate_delta'] = (integral_term * df['ag'].astype(float))/1e18
+
+    # create total per-second rate
+    df['total_rate'] = (1e27 + df['p_rate_delta'] + df['i_rate_delta'])
+
+    # convert these to per-second rates
+    df['p_rate'] = 1e27 + df['p_rate_delta']
+    df['i_rate'] = 1e27 + df['i_rate_delta']
+
+    # calculate annual rates
+    df['redemptionRate_apy'] = rate_apy(df['redemptionRate'])
+    df['total_rate_apy'] = rate_apy(df['total_rate'])
+    df['p_rate_apy'] = rate_apy(df['p_rate'])
+    df['i_rate_apy'] = rate_apy(df['i_rate'])
+    df['apy_diff'] = df['redemptionRate_apy'] - df['total_rate_apy']
+
+    return df
+
+def read_manifest(store_dir):
+    path = os.path.join(store_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fp:
+        return json.load(fp)
+
+def exact(value):
+    # an integer column value as an int, or a float for the terms of older rows
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+def read_part(store_dir, part):
+    # round_trip so floats read back exactly as they were derived
+    return pd.read_csv(os.path.join(store_dir, part['file']), float_precision='round_trip',
+                       converters={col: exact for col in INT_COLUMNS})
+
+def last_block(store_dir):
+    """
+    Returns the last block processed into `store_dir`, None for an empty store
+    """
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        return None
+    return manifest['last_block']
+
+def append_events(store_dir, df_new, part_size=1000):
+    """
+    Derive columns for new events `df_new` and append them to `store_dir`. The event
+    columns are written as they are, RAY integers included, so the store holds the
+    exact on-chain values.
+
+    The store is a directory of gzipped csv parts of at most `part_size` events and a
+    manifest holding the last processed block. New events go into the last part while
+    it has room, so a run rewrites at most one part and the manifest, whatever the
+    length of the history.
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory of the event store
+    df_new : pd.DataFrame
+        Events with `RAW_COLUMNS`, sorted by block
+    part_size : int
+        Maximum number of events per part
+    Returns
+    -------
+    int
+        Number of events appended
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    manifest = read_manifest(store_dir) or {'last_block': None, 'n_rows': 0, 'parts': []}
+
+    if manifest['last_block'] is not None:
+        df_new = df_new[df_new['blockNumber'] > manifest['last_block']]
+    if len(df_new) == 0:
+        return 0
+
+    df_new = derive(df_new[RAW_COLUMNS])
+
+    parts = manifest['parts']
+    n_appended = len(df_new)
+    if parts and parts[-1]['n_rows'] < part_size:
+        # refill the last part instead of starting a new file every run
+        df_new = pd.concat([read_part(store_dir, parts.pop()), df_new], ignore_index=True)
+
+    for i in range(0, len(df_new), part_size):
+        chunk = df_new.iloc[i:i + part_size]
+        first_block = int(chunk['blockNumber'].iloc[0])
+        file_name = f"part_{first_block}.csv.gz"
+        # mtime=0 so rewriting a part with the same rows gives the same bytes
+        write_atomic(os.path.join(store_dir, file_name),
+                     gzip.compress(chunk.to_csv(index=False).encode(), mtime=0))
+        parts.append({'file': file_name, 'first_block': first_block,
+                      'last_block': int(chunk['blockNumber'].iloc[-1]), 'n_rows': len(chunk)})
+
+    manifest['last_block'] = parts[-1]['last_block']
+    manifest['n_rows'] += n_appended
+    write_atomic(os.path.join(store_dir, MANIFEST), json.dumps(manifest, indent=1).encode())
+
+    return n_appended
+
+def load(store_dir=STORE_DIR, tail=None):
+    """
+    Returns the events of `store_dir` with derived columns. With `tail`, only the
+    parts holding the last `tail` events are read.
+    """
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        return pd.DataFrame(columns=RAW_COLUMNS)
+
+    parts = []
+    n_rows = 0
+    for part in reversed(manifest['parts']):
+        if tail is not None and n_rows >= tail:
+            break
+        parts.append(part)
+        n_rows += part['n_rows']
+
+    df = pd.concat([read_part(store_dir, part) for part in reversed(parts)], ignore_index=True)
+    if tail is not None:
+        df = df.tail(tail)
+
+    return df
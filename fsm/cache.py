@@ -0,0 +1 @@
+../common/cache.py
\ No newline at end of file
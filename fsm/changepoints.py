@@ -0,0 +1 @@
+../common/changepoints.py
\ No newline at end of file
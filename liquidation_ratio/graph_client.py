@@ -0,0 +1,139 @@
+import re
+import json
+import time
+import numpy as np
+import pandas as pd
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import METRICS
+
+class GraphClient():
+    """
+    GraphQL client for a subgraph, reusing one pooled `requests.Session`
+    """
+    def __init__(self, url, session=None, timeout=30, tries=3):
+        self.url = url
+        self.session = session or requests.Session()
+        self.timeout = timeout
+        self.tries = tries
+
+    def query(self, query, variables=None):
+        """
+        Returns the `data` of `query`, retrying failed requests. Calls, latency,
+        retries and bytes are recorded in `METRICS` by queried entity.
+        """
+        entity = query_entity(query)
+        data = json.dumps({'query': query, 'variables': variables or {}})
+        for attempt in range(self.tries):
+            METRICS.count('graphql_calls_total', entity=entity)
+            try:
+                with METRICS.timer('graphql_seconds', entity=entity):
+                    r = self.session.post(self.url, data=data, headers={'Content-Type': 'application/json'},
+                                          timeout=self.timeout)
+                    r.raise_for_status()
+                    result = r.json()
+                METRICS.transfer(len(data), len(r.content), entity=entity)
+            except (requests.RequestException, ValueError) as e:
+                if attempt == self.tries - 1:
+                    raise
+                print(e)
+                METRICS.count('graphql_retries_total', entity=entity)
+                time.sleep(attempt + 1)
+                continue
+
+            if result.get('errors'):
+                raise ValueError(f"subgraph query failed: {result['errors']}")
+            return result['data']
+
+    def indexed_block(self):
+        """
+        Returns the last block indexed by the subgraph
+        """
+        return self.query('query { _meta { block { number } } }')['_meta']['block']['number']
+
+    def pages(self, entity, fields, where=None, page_size=1000, prefetch=True, block=None):
+        """
+        Yield all `entity` records page by page with keyset pagination on `id`.
+
+        Every page asks for `page_size` records with an id greater than the last id of
+        the previous page, so requests cost the same however deep the pagination goes,
+        unlike `skip`. With `prefetch`, the next page is requested in a background thread
+        while the caller processes the current one.
+
+        Parameters
+        ----------
+        entity : str
+            Collection to query, ie. safes
+        fields : str
+            GraphQL selection of each record, `id` is always added
+        where : str
+            Extra filter conditions, ie. 'debt_gt: 0'
+        page_size : int
+            Records per request, at most 1000 on hosted subgraphs
+        block : int
+            Query the state at this block instead of the latest indexed one
+        Yields
+        ------
+        list[dict]
+            Records of one page
+        """
+        # the cursor is inlined as a literal, id_gt takes ID, String or Bytes depending on the entity
+        query = '''
+        query {{
+            {entity}({block}first: {first}, orderBy: id, orderDirection: asc,
+                     where: {{id_gt: "{last_id}"{where}}}) {{
+                id
+                {fields}
+            }}
+        }}'''
+
+        def fetch(last_id):
+            q = query.format(entity=entity, first=page_size, last_id=last_id, fields=fields,
+                             where=', ' + where if where else '', block=block_arg(block))
+            return self.query(q)[entity]
+
+        with ThreadPoolExecutor(1) as executor:
+            page = fetch('')
+            while page:
+                last_page = len(page) < page_size
+                if prefetch and not last_page:
+                    next_page = executor.submit(fetch, page[-1]['id'])
+                yield page
+                if last_page:
+                    break
+                page = next_page.result() if prefetch else fetch(page[-1]['id'])
+
+def query_entity(query):
+    # first field selected by a query, ie. safes, as its metrics label
+    match = re.search(r'\{\s*(\w+)', query)
+    return match.group(1) if match else 'query'
+
+def block_arg(block):
+    # `block` argument pinning a subgraph query to a block number
+    return '' if block is None else f'block: {{number: {int(block)}}}, '
+
+class ColumnBuilder():
+    """
+    Collects records into typed numpy columns, one page at a time.
+
+    `columns` maps each field to its dtype, ie. {'safeId': str, 'debt': float}.
+    Subgraph BigDecimal strings are parsed straight into float columns.
+    """
+    def __init__(self, columns):
+        self.columns = columns
+        self.chunks = {name: [] for name in columns}
+
+    def append(self, records):
+        for name, dtype in self.columns.items():
+            self.chunks[name].append(np.array([x[name] for x in records], dtype=dtype))
+
+    def frame(self):
+        data = {}
+        for name, dtype in self.columns.items():
+            chunks = self.chunks[name]
+            data[name] = np.concatenate(chunks) if chunks else np.array([], dtype=dtype)
+            if dtype is str:
+                data[name] = data[name].astype(object)
+
+        return pd.DataFrame(data)
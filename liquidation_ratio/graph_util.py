@@ -1,90 +1,58 @@
-import requests
-import json
-import pandas as pd
+from graph_client import GraphClient, ColumnBuilder, block_arg
 
-def fetch_safes(url):
+def fetch_safes(url, page_size=1000, prefetch=True, client=None, block=None):
+    """
+    Returns a DataFrame of all SAFEs with float `collateral` and `debt`
+    """
+    client = client or GraphClient(url)
+    safes = ColumnBuilder({'safeId': str, 'collateral': float, 'debt': float})
+    for page in client.pages('safes', 'safeId collateral debt', page_size=page_size, prefetch=prefetch, block=block):
+        safes.append(page)
 
-    query = '''
-    query {{
-        safes(first: 1000, skip:{}) {{
-            safeId
-            collateral
-            debt
-        }}
-    }}'''
-
-    n = 0
-    safes = []
-    while True:
-        r = requests.post(url, json = {'query':query.format(n*1000)})
-        s = json.loads(r.content)['data']['safes']
-        safes.extend(s)
-        n += 1
-        if len(s) < 1000:
-            break
-    safes = pd.DataFrame(safes)
-    safes['collateral'] = safes['collateral'].astype(float)
-    safes['debt'] = safes['debt'].astype(float)
-    #safes['safeId'] = safes['safeId'].astype(int)
-
-    return safes
+    return safes.frame()
 
-def fetch_rp(url):
+def fetch_rp(url, client=None, block=None):
 
     query =  '''
-    query {
-        systemState(id:"current") {
-        currentRedemptionPrice {
-            value }
-        }
-    }'''
-    r = requests.post(url, json = {'query':query})
-    s = json.loads(r.content)['data']['systemState']['currentRedemptionPrice']['value']
+    query {{
+        systemState({}id:"current") {{
+        currentRedemptionPrice {{
+            value }}
+        }}
+    }}'''.format(block_arg(block))
+    client = client or GraphClient(url)
+    s = client.query(query)['systemState']['currentRedemptionPrice']['value']
 
     return float(s)
 
-def fetch_debt_ceiling(url):
+def fetch_debt_ceiling(url, client=None, block=None):
 
     query =  '''
-    query {
-        collateralType(id:"ETH-A") {
+    query {{
+        collateralType({}id:"ETH-A") {{
         debtCeiling
-        }
-    }'''
-    r = requests.post(url, json = {'query':query})
-    s = json.loads(r.content)['data']['collateralType']['debtCeiling']
+        }}
+    }}'''.format(block_arg(block))
+    client = client or GraphClient(url)
+    s = client.query(query)['collateralType']['debtCeiling']
 
     return float(s)
 
 
-def fetch_saviour_safes(url):
-
-    query = '''
-    query {{
-        safeSaviours(first: 1000, skip:{}) {{
-            safes {{
-            safeId
-            safeHandler
-            collateral
-            debt            
-            }}
-        }}
-    }}'''
-
-    n = 0
-    safes = []
-    while True:
-        r = requests.post(url, json = {'query':query.format(n*1000)})
-        #print(json.loads(r.content)['data'])
-        saviours = json.loads(r.content)['data']['safeSaviours']
-        for s in saviours:
-            safes.extend(s['safes'])
-        n += 1
-        if len(s) < 1000:
-            break
-    safes = pd.DataFrame(safes)
-    safes['collateral'] = safes['collateral'].astype(float)
-    safes['debt'] = safes['debt'].astype(float)
-    #safes['safeId'] = safes['safeId'].astype(int)
-
-    return safes
\ No newline at end of file
+def fetch_saviour_safes(url, page_size=1000, prefetch=True, client=None, block=None):
+    """
+    Returns a DataFrame of the SAFEs protected by a saviour with float `collateral` and `debt`
+    """
+    client = client or GraphClient(url)
+    fields = '''safes(first: 1000) {
+                safeId
+                safeHandler
+                collateral
+                debt
+            }'''
+    safes = ColumnBuilder({'safeId': str, 'safeHandler': str, 'collateral': float, 'debt': float})
+    for page in client.pages('safeSaviours', fields, page_size=page_size, prefetch=prefetch, block=block):
+        for saviour in page:
+            safes.append(saviour['safes'])
+
+    return safes.frame()
@@ -0,0 +1,60 @@
+import numpy as np
+
+class SortedSafes():
+    '''
+    SAFE population sorted once by collateral/debt, with cumulative sums.
+
+    A SAFE's c-ratio is collateral * eth_price / (debt * redemption_price), so it is
+    below `liq_ratio` exactly when collateral/debt < liq_ratio * redemption_price / eth_price.
+    The SAFEs liquidated at any prices are a prefix of the sorted population and
+    their totals are read off the cumulative sums with one searchsorted.
+    '''
+    def __init__(self, collateral, debt, **columns):
+        collateral = np.asarray(collateral, dtype=float)
+        debt = np.asarray(debt, dtype=float)
+
+        # SAFEs without debt are never liquidated
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(debt > 0, collateral / debt, np.inf)
+        order = np.argsort(ratio, kind='stable')
+
+        self.ratio = ratio[order]
+        self.cum = {name: np.concatenate([[0.], np.cumsum(np.asarray(x, dtype=float)[order])])
+                    for name, x in dict(columns, collateral=collateral, debt=debt).items()}
+
+    def __len__(self):
+        return len(self.ratio)
+
+    @classmethod
+    def from_frame(cls, safes, columns=()):
+        '''
+        From a DataFrame with `collateral` and `debt` columns, also summing `columns`
+        '''
+        return cls(safes['collateral'].values, safes['debt'].values,
+                   **{name: safes[name].values for name in columns})
+
+    def n_critical(self, eth_price, redemption_price, liq_ratio, debt_adj=1):
+        '''
+        Number of SAFEs with c-ratio below `liq_ratio`, broadcasting over array arguments.
+        `debt_adj` multiplies every SAFE's debt, as `adjust_safe_debt_and_cratios`.
+        '''
+        threshold = np.asarray(liq_ratio) * redemption_price * debt_adj / np.asarray(eth_price)
+        return np.searchsorted(self.ratio, threshold, side='left')
+
+    def critical(self, eth_price, redemption_price, liq_ratio, debt_adj=1):
+        '''
+        Returns (critical_collateral, critical_debt), the totals `liquidate_critical`
+        returns after `update_cratios`, for scalars or arrays of prices and liq ratios.
+
+        Example:
+        eth_prices = ETH_USD * (1 - SHOCKS)
+        collateral, debt = safes.critical(eth_prices, REDEMPTION_PRICE, 1.35)
+        '''
+        n = self.n_critical(eth_price, redemption_price, liq_ratio, debt_adj)
+        return self.cum['collateral'][n], self.cum['debt'][n] * debt_adj
+
+    def critical_sum(self, name, eth_price, redemption_price, liq_ratio, debt_adj=1):
+        '''
+        Total of extra column `name` over the SAFEs below `liq_ratio`, ie. lp_syscoin
+        '''
+        return self.cum[name][self.n_critical(eth_price, redemption_price, liq_ratio, debt_adj)]
@@ -0,0 +1,176 @@
+import numpy as np
+import pandas as pd
+
+class Populations():
+    '''
+    Synthetic SAFE populations as padded 2-D column arrays, one row per population.
+
+    Row i holds `lengths[i]` SAFEs, the rest of the row is padding with zero
+    collateral and debt and a nan c-ratio.
+    '''
+    def __init__(self, collateral, debt, cratio, lengths):
+        self.collateral = collateral
+        self.debt = debt
+        self.cratio = cratio
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def total_debt(self):
+        return self.debt.sum(axis=1)
+
+    def frame(self, i):
+        '''
+        Returns population `i` as a DataFrame with cratio, collateral and debt columns
+        '''
+        n = self.lengths[i]
+        return pd.DataFrame({'cratio': self.cratio[i, :n], 'collateral': self.collateral[i, :n],
+                             'debt': self.debt[i, :n]})
+
+    def frames(self):
+        return [self.frame(i) for i in range(len(self))]
+
+def rv_draw(cratio_rv, collateral_rv=None, collaterals=None, log_collateral=True):
+    '''
+    Draw function of independent c-ratios and collaterals for `generate_populations`.
+
+    Parameters
+    ----------
+    cratio_rv : scipy.stats frozen distribution
+        Distribution of c-ratios
+    collateral_rv : scipy.stats frozen distribution
+        Distribution of collateral, of log collateral if `log_collateral`
+    collaterals : array
+        Collateral amounts resampled with replacement when `collateral_rv` is None,
+        ie. the mainnet SAFEs collateral
+    '''
+    def draw(rng, shape):
+        cratio = cratio_rv.rvs(size=shape, random_state=rng)
+        if collateral_rv is None:
+            collateral = rng.choice(np.asarray(collaterals, dtype=float), size=shape)
+        else:
+            collateral = collateral_rv.rvs(size=shape, random_state=rng)
+            if log_collateral:
+                # heavy tails overflow to inf, which `max_collateral` filters out
+                with np.errstate(over='ignore'):
+                    collateral = np.exp(collateral)
+        return cratio, collateral
+
+    return draw
+
+def gaussian_draw(mean, cov):
+    '''
+    Draw function of jointly normal (log collateral, c-ratio) for `generate_populations`,
+    ie. one component of a fitted GaussianMixture: gaussian_draw(mix.means_[0], mix.covariances_[0])
+    '''
+    def draw(rng, shape):
+        x = rng.multivariate_normal(mean, cov, size=shape)
+        return x[..., 1], np.exp(x[..., 0])
+
+    return draw
+
+def draw_valid(draw, rng, n_pops, n, liq_ratio, max_collateral):
+    # (cratio, collateral) arrays of shape (n_pops, n), each row holding the first
+    # n draws above `liq_ratio` and within (0, max_collateral)
+    cratio = np.empty((n_pops, 0))
+    collateral = np.empty((n_pops, 0))
+    size = 2 * n
+    while True:
+        cr, coll = draw(rng, (n_pops, size))
+        cratio = np.hstack([cratio, cr])
+        collateral = np.hstack([collateral, coll])
+
+        valid = (cratio > liq_ratio) & (collateral > 0) & (collateral < max_collateral)
+        if valid.sum(axis=1).min() >= n:
+            break
+        size = n
+
+    # stable sort moves the valid draws of each row to the front, keeping draw order
+    order = np.argsort(~valid, axis=1, kind='stable')[:, :n]
+    return np.take_along_axis(cratio, order, axis=1), np.take_along_axis(collateral, order, axis=1)
+
+def generate_populations(draw, n_pops, n_safes, eth_price, redemption_price, liq_ratio, debt_ceiling,
+                         collateral=None, max_collateral=np.inf, seed=None, dtype=np.float64):
+    '''
+    Generate `n_pops` synthetic SAFE populations filled up to the debt ceiling.
+
+    Every population starts with `n_safes` SAFEs, drawn for all populations at once
+    as (n_pops, n_safes) arrays and truncated to c-ratios above `liq_ratio` and
+    collateral in (0, max_collateral) by keeping the first valid draws of each row.
+    Populations below `debt_ceiling` are then topped up from one more batch of draws:
+    the extra SAFEs are taken up to the first one where the cumulative debt reaches
+    the missing debt, and that last SAFE's debt is reduced to land on the ceiling
+    exactly (its c-ratio is recomputed).
+
+    Parameters
+    ----------
+    draw : function
+        draw(rng, shape) -> (cratio, collateral) arrays of `shape`, see `rv_draw`
+        and `gaussian_draw`
+    n_pops : int
+        Number of populations
+    n_safes : int
+        Initial SAFEs per population, ignored when `collateral` is given
+    eth_price : float
+    redemption_price : float
+    liq_ratio : float
+        Lower bound of generated c-ratios
+    debt_ceiling : float
+    collateral : array
+        Fixed collateral of the initial SAFEs, ie. the mainnet SAFEs. Only c-ratios are
+        drawn for them.
+    max_collateral : float
+        Upper bound of generated collaterals
+    seed : int or np.random.Generator
+        Same seed, same populations
+    dtype : np.dtype
+        dtype of the returned arrays, float32 halves their memory
+    Returns
+    -------
+    Populations
+    '''
+    rng = np.random.default_rng(seed)
+
+    if collateral is not None:
+        collateral = np.asarray(collateral, dtype=float)
+        n_safes = len(collateral)
+        cratio, _ = draw_valid(draw, rng, n_pops, n_safes, liq_ratio, np.inf)
+        collateral = np.broadcast_to(collateral, cratio.shape)
+    else:
+        cratio, collateral = draw_valid(draw, rng, n_pops, n_safes, liq_ratio, max_collateral)
+
+    debt = collateral * eth_price / redemption_price / cratio
+    extra_debt = debt_ceiling - debt.sum(axis=1)
+
+    n_extra = np.zeros(n_pops, dtype=int)
+    top_up = extra_debt > 0
+    if top_up.any():
+        # enough draws for twice the average number of SAFEs missing
+        size = int(np.ceil(2 * extra_debt.max() / debt.mean())) + 16
+        extra_cratio, extra_collateral = draw_valid(draw, rng, n_pops, size, liq_ratio, max_collateral)
+        extra = extra_collateral * eth_price / redemption_price / extra_cratio
+        cum_debt = np.cumsum(extra, axis=1)
+
+        while (cum_debt[top_up, -1] < extra_debt[top_up]).any():
+            cr, coll = draw_valid(draw, rng, n_pops, size, liq_ratio, max_collateral)
+            extra_cratio = np.hstack([extra_cratio, cr])
+            extra_collateral = np.hstack([extra_collateral, coll])
+            extra = np.hstack([extra, coll * eth_price / redemption_price / cr])
+            cum_debt = np.cumsum(extra, axis=1)
+
+        # SAFEs up to and including the first reaching the missing debt
+        n_extra = np.where(top_up, (cum_debt < extra_debt[:, None]).sum(axis=1) + 1, 0)
+        width = n_extra.max()
+        keep = np.arange(width) < n_extra[:, None]
+
+        rows = np.flatnonzero(top_up)
+        last = n_extra[rows] - 1
+        extra[rows, last] = extra_debt[rows] - np.where(last > 0, cum_debt[rows, last - 1], 0)
+        extra_cratio[rows, last] = extra_collateral[rows, last] * eth_price / redemption_price / extra[rows, last]
+
+        cratio = np.hstack([cratio, np.where(keep, extra_cratio[:, :width], np.nan)])
+        collateral = np.hstack([collateral, np.where(keep, extra_collateral[:, :width], 0)])
+        debt = np.hstack([debt, np.where(keep, extra[:, :width], 0)])
+
+    return Populations(collateral.astype(dtype), debt.astype(dtype), cratio.astype(dtype), n_safes + n_extra)
@@ -0,0 +1,113 @@
+import numpy as np
+
+# One component GaussianMixture of hourly (rai_eth, eth_usd) returns over the Uni V2
+# only period, fitted in ETHUSD and RAIUSD.ipynb
+V2_WEIGHTS = np.array([1.])
+V2_MEANS = np.array([[-0.00045541, 0.00047911]])
+V2_COVS = np.array([[[4.13783784e-05, -3.19083822e-05],
+                     [-3.19083822e-05, 9.39901212e-05]]])
+
+def mixture_params(mixture):
+    '''
+    (weights, means, covs) of a bivariate gaussian mixture, covs as (K, 2, 2) arrays.
+
+    Parameters
+    ----------
+    mixture : sklearn.mixture.GaussianMixture or tuple
+        Fitted on (rai_eth, eth_usd) returns, any number of components and
+        covariance type, or a (weights, means, covs) tuple of full covariances
+    Returns
+    -------
+    tuple
+    '''
+    if isinstance(mixture, tuple):
+        weights, means, covs = mixture
+        return np.asarray(weights, dtype=float), np.asarray(means, dtype=float), np.asarray(covs, dtype=float)
+
+    weights = np.asarray(mixture.weights_, dtype=float)
+    means = np.asarray(mixture.means_, dtype=float)
+    covs = np.asarray(mixture.covariances_, dtype=float)
+    k, d = means.shape
+    if mixture.covariance_type == 'tied':
+        covs = np.broadcast_to(covs, (k, d, d))
+    elif mixture.covariance_type == 'diag':
+        covs = covs[:, :, None] * np.eye(d)
+    elif mixture.covariance_type == 'spherical':
+        covs = covs[:, None, None] * np.eye(d)
+    return weights, means, covs
+
+def conditional(mixture, eth_returns):
+    '''
+    Mixture of rai_eth returns given each eth_usd return.
+
+    Conditioning a gaussian mixture on x2 = a gives a gaussian mixture of x1: each
+    component k is reweighted by its density of a, and has mean
+    mu1 + cov12 / cov22 * (a - mu2) and variance cov11 - cov12^2 / cov22.
+
+    Parameters
+    ----------
+    mixture : see `mixture_params`
+    eth_returns : array
+        ETH/USD returns, ie. -shock
+    Returns
+    -------
+    tuple
+        (weights, means, sds): weights and means of shape (len(eth_returns), K),
+        sds of shape (K,)
+    '''
+    weights, means, covs = mixture_params(mixture)
+    a = np.asarray(eth_returns, dtype=float)[:, None]
+    mu1, mu2 = means[:, 0], means[:, 1]
+    cov11, cov12, cov22 = covs[:, 0, 0], covs[:, 0, 1], covs[:, 1, 1]
+
+    # component responsibilities of each eth return, in logs as large shocks are far
+    # in the tails of every component
+    log_w = np.log(weights) - 0.5 * np.log(2 * np.pi * cov22) - 0.5 * (a - mu2)**2 / cov22
+    log_w -= log_w.max(axis=1, keepdims=True)
+    cond_weights = np.exp(log_w)
+    cond_weights /= cond_weights.sum(axis=1, keepdims=True)
+
+    cond_means = mu1 + cov12 / cov22 * (a - mu2)
+    cond_sds = np.sqrt(cov11 - cov12**2 / cov22)
+    return cond_weights, cond_means, cond_sds
+
+def sample_rai_shocks(shocks, n, mixture=(V2_WEIGHTS, V2_MEANS, V2_COVS), seed=42):
+    '''
+    RAI/USD price multipliers of `n` draws for each ETH/USD shock, as one array.
+
+    RAI/ETH returns are drawn from their conditional distribution given an ETH/USD
+    return of -shock, and a RAI/USD multiplier is (1 - shock) * (1 + rai_eth return).
+
+    All shocks use the same random numbers: draw j is the same standard normal and
+    the same uniform, which picks the component, mapped through each shock's
+    conditional. Differences between shocks are then not blurred by sampling
+    noise, and results are monotone in the shock for a single component.
+
+    Parameters
+    ----------
+    shocks : array
+        ETH/USD shocks, ie. 0.1 for a 10% drop
+    n : int
+        Draws per shock
+    mixture : see `mixture_params`
+        Defaults to the V2 fit of ETHUSD and RAIUSD.ipynb
+    seed : int
+    Returns
+    -------
+    np.ndarray
+        Shape (len(shocks), n), row i holds the draws of shocks[i]
+    '''
+    shocks = np.asarray(shocks, dtype=float)
+    weights, means, sds = conditional(mixture, -shocks)
+
+    rng = np.random.default_rng(seed)
+    z = rng.standard_normal(n)
+    u = rng.random(n)
+
+    # component of each draw by inverting the cumulative weights of each shock
+    cum_weights = np.cumsum(weights, axis=1)
+    k = (u[None, :, None] > cum_weights[:, None, :]).sum(axis=2)
+    k = np.minimum(k, weights.shape[1] - 1)
+
+    rai_eth_returns = np.take_along_axis(means, k, axis=1) + sds[k] * z
+    return (1 - shocks)[:, None] * (1 + rai_eth_returns)
@@ -0,0 +1,204 @@
+import numpy as np
+import pandas as pd
+
+# ETH/USD drops of the shock simulations, 0 to 60%
+SHOCKS = np.round(np.linspace(0, 0.6, 61), 4)
+
+HORIZONS = ('1h', '4h', '12h', '1d', '3d', '7d')
+
+def load_binance(path='Binance_ETHUSDT_1h.csv', min_volume=None):
+    '''
+    Binance hourly candles indexed by UTC open time, oldest first.
+
+    Parameters
+    ----------
+    path : str
+    min_volume : float
+        Drop candles trading less ETH, ie. 1000 to filter out the bad ticks of 2017
+    Returns
+    -------
+    pd.DataFrame
+        high, low and close columns
+    '''
+    df = pd.read_csv(path)
+    # early rows are in secs, later ones in ms
+    unix = df['unix'].astype(float)
+    unix = np.where(unix < 1e11, unix * 1000, unix)
+    df.index = pd.DatetimeIndex(pd.to_datetime(unix, unit='ms', utc=True), name='time')
+    if min_volume is not None:
+        df = df[df['Volume ETH'] > min_volume]
+    return df[['high', 'low', 'close']].astype(float).sort_index()
+
+def load_osm(path='mkr_osm_int.csv'):
+    '''
+    MakerDAO ETH OSM prices indexed by UTC time, oldest first
+    '''
+    df = pd.read_csv(path)
+    prices = pd.Series(df['price'].astype(float).values / 1E18, name='price',
+                       index=pd.DatetimeIndex(pd.to_datetime(df['ts'], format='%Y-%m-%d %H:%M:%S UTC', utc=True),
+                                              name='time'))
+    return prices.sort_index()
+
+def bars(feed, freq='1h'):
+    '''
+    Regular high/low/close bars of a price feed.
+
+    Candles are aggregated with their highs and lows. A price series is a step
+    function, so each bar also holds the price carried in from the previous one,
+    ie. an hourly OSM bar spans the previous and the new price. Empty bars repeat
+    the last close.
+
+    Parameters
+    ----------
+    feed : pd.DataFrame or pd.Series
+        Candles with high, low and close columns, or prices, indexed by time
+    freq : str
+        Bar length
+    Returns
+    -------
+    pd.DataFrame
+    '''
+    if isinstance(feed, pd.Series):
+        r = feed.resample(freq)
+        close = r.last().ffill()
+        carry = close.shift(1)
+        high = np.fmax(r.max(), carry).fillna(close)
+        low = np.fmin(r.min(), carry).fillna(close)
+    else:
+        r = feed.resample(freq)
+        close = r['close'].last().ffill()
+        high = r['high'].max().fillna(close)
+        low = r['low'].min().fillna(close)
+    return pd.DataFrame({'high': high, 'low': low, 'close': close})
+
+def sliding_max(x, window):
+    '''
+    Max of each trailing window of `window` values, ignoring nans.
+
+    Linear time van Herk/Gil-Werman: the array is cut in blocks of `window`, and a
+    window ending at i is the max of the suffix max of its first block and the
+    prefix max of its last one. Windows shorter than `window` at the start are the
+    max of the values so far.
+
+    Parameters
+    ----------
+    x : array
+    window : int
+    Returns
+    -------
+    np.ndarray
+    '''
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if window <= 1 or n == 0:
+        return x.copy()
+    blocks = np.concatenate([x, np.full(-n % window, np.nan)]).reshape(-1, window)
+    prefix = np.fmax.accumulate(blocks, axis=1).ravel()
+    suffix = np.fmax.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+
+    out = prefix[:n].copy()
+    i = np.arange(window - 1, n)
+    out[window - 1:] = np.fmax(suffix[i - window + 1], prefix[i])
+    return out
+
+def sliding_min(x, window):
+    '''
+    Min of each trailing window of `window` values, see `sliding_max`
+    '''
+    return -sliding_max(-np.asarray(x, dtype=float), window)
+
+def horizon_bars(horizon, freq='1h'):
+    n = pd.Timedelta(horizon) / pd.Timedelta(freq)
+    if n < 1 or n != int(n):
+        raise ValueError(f"horizon {horizon} is not a multiple of the {freq} bars")
+    return int(n)
+
+def drawdowns(feed, horizons=HORIZONS, freq='1h'):
+    '''
+    Worst peak-to-trough drop into every bar, for many horizons at once.
+
+    The drop of a bar over horizon h is its low over the highest high of the bars
+    within h up to it, minus 1. Every (peak, trough) pair less than h apart is the
+    drop of the trough's bar, so the min over bars is the worst drop of any h
+    window. Bars without a full window are nan.
+
+    Parameters
+    ----------
+    feed : pd.DataFrame or pd.Series
+        Candles or prices indexed by time, see `bars`
+    horizons : list[str]
+        Window lengths, multiples of `freq`
+    freq : str
+        Bar length
+    Returns
+    -------
+    pd.DataFrame
+        Drops as negative fractions, indexed by bar time, one column per horizon
+    '''
+    b = bars(feed, freq)
+    high = b['high'].to_numpy()
+    low = b['low'].to_numpy()
+
+    drops = {}
+    for h in horizons:
+        n = horizon_bars(h, freq)
+        drop = low / sliding_max(high, n) - 1
+        drop[:n - 1] = np.nan
+        drops[h] = drop
+    return pd.DataFrame(drops, index=b.index)
+
+def exceedance(drops, shocks=SHOCKS, how='fraction', freq='1h'):
+    '''
+    How often the drops of each horizon reach each shock of a grid.
+
+    Each horizon's drops are sorted once and every shock is a binary search.
+
+    Parameters
+    ----------
+    drops : pd.DataFrame
+        See `drawdowns`
+    shocks : array
+        Drops as positive fractions, ie. `SHOCKS`
+    how : str
+        'count' of bars with a drop of at least the shock, 'fraction' of the bars,
+        or 'events': the count over the bars per horizon, as overlapping windows
+        see one crash several times
+    freq : str
+        Bar length of `drops`, for 'events'
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by shock, one column per horizon
+    '''
+    shocks = np.asarray(shocks, dtype=float)
+    result = {}
+    for h in drops.columns:
+        d = np.sort(drops[h].dropna().to_numpy())
+        counts = np.searchsorted(d, -shocks, side='right')
+        if how == 'count':
+            result[h] = counts
+        elif how == 'fraction':
+            result[h] = counts / len(d) if len(d) else np.full(len(shocks), np.nan)
+        elif how == 'events':
+            result[h] = counts / horizon_bars(h, freq)
+        else:
+            raise ValueError(f"unknown how {how}")
+    return pd.DataFrame(result, index=pd.Index(shocks, name='shock'))
+
+def tail_quantiles(drops, quantiles=(0.01, 0.001, 0.0001)):
+    '''
+    Lower quantiles of the drops of each horizon
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by quantile, one column per horizon
+    '''
+    return drops.quantile(list(quantiles)).rename_axis('quantile')
+
+def shock_table(feed, shocks=SHOCKS, horizons=HORIZONS, freq='1h', how='fraction'):
+    '''
+    Exceedance of a shock grid over many horizons of a feed in one call, ie.
+    shock_table(load_binance(min_volume=1000), how='events')
+    '''
+    return exceedance(drawdowns(feed, horizons, freq), shocks, how, freq)
@@ -0,0 +1,62 @@
+import pickle
+from web3 import Web3
+
+from graph_client import GraphClient
+from graph_util import fetch_safes, fetch_rp, fetch_debt_ceiling, fetch_saviour_safes
+from web3_util import fetch_saviour_targets_batch
+from rpc_pool import provider
+
+def fetch_snapshot(graph_url, eth_rpc_url, block=None, eth_usd=None):
+    """
+    Fetch the system state the shock simulations start from, all at one block.
+
+    Every subgraph query is pinned with `block: {number: block}` and the saviour
+    contract reads are made at the same block, so SAFEs, saviour SAFEs, redemption
+    price and debt ceiling are consistent with each other.
+
+    Parameters
+    ----------
+    graph_url : str
+        RAI subgraph url
+    eth_rpc_url : str or rpc_pool.RPCPool
+        ethereum rpc url or a pool of them, archive nodes if `block` is old
+    block : int
+        Block to snapshot, defaults to the last block indexed by the subgraph
+    eth_usd : float
+        ETH/USD price to store with the snapshot, ie. from coingecko
+    Returns
+    -------
+    dict
+        block, timestamp, eth_usd, redemption_price, debt_ceiling, safes and
+        saviour_safes (with target c-ratio and LP underlying columns)
+    """
+    client = GraphClient(graph_url)
+    if block is None:
+        block = client.indexed_block()
+
+    w3 = Web3(provider(eth_rpc_url))
+    timestamp = w3.eth.get_block(block)['timestamp']
+
+    saviour_safes = fetch_saviour_safes(graph_url, client=client, block=block)
+    saviour_safes = fetch_saviour_targets_batch(eth_rpc_url, saviour_safes, block)
+
+    return {
+        'block': block,
+        'timestamp': timestamp,
+        'eth_usd': eth_usd,
+        'redemption_price': fetch_rp(graph_url, client=client, block=block),
+        'debt_ceiling': fetch_debt_ceiling(graph_url, client=client, block=block),
+        'safes': fetch_safes(graph_url, client=client, block=block),
+        'saviour_safes': saviour_safes,
+    }
+
+def save_snapshot(snapshot, path):
+    """
+    Write `snapshot` to the single file `path`
+    """
+    with open(path, 'wb') as fp:
+        pickle.dump(snapshot, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_snapshot(path):
+    with open(path, 'rb') as fp:
+        return pickle.load(fp)
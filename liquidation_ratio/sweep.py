@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+class SharedPopulations():
+    '''
+    SAFE populations stored once in shared memory.
+
+    Pickling only sends the segment name and offsets, so worker processes attach to
+    the same buffer instead of receiving a copy of every population.
+    '''
+    def __init__(self, populations, columns=('collateral', 'debt')):
+        self.columns = list(columns)
+        lengths = [len(p) for p in populations]
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).tolist()
+
+        n = max(self.offsets[-1], 1) * len(self.columns)
+        self.shm = shared_memory.SharedMemory(create=True, size=n * 8)
+        self.name = self.shm.name
+        data = self._array()
+        for i, p in enumerate(populations):
+            for j, col in enumerate(self.columns):
+                data[j, self.offsets[i]:self.offsets[i + 1]] = np.asarray(p[col], dtype=float)
+        self.owner = True
+
+    def _array(self):
+        return np.ndarray((len(self.columns), max(self.offsets[-1], 1)), dtype=np.float64, buffer=self.shm.buf)
+
+    def __getstate__(self):
+        return {'name': self.name, 'columns': self.columns, 'offsets': self.offsets}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=self.name)
+        self.owner = False
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def frames(self):
+        '''
+        Returns one DataFrame per population over the shared buffer
+        '''
+        data = self._array()
+        return [pd.DataFrame({col: data[j, self.offsets[i]:self.offsets[i + 1]] for j, col in enumerate(self.columns)},
+                             copy=False)
+                for i in range(len(self))]
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def config_key(config):
+    # stable file name for a config dict
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=float).encode()).hexdigest()[:16]
+
+def write_part(path, df):
+    tmp = path + '.tmp'
+    df.to_csv(tmp, index=False, compression='gzip')
+    os.replace(tmp, path)
+
+# state of each worker process, set by `init_worker`
+_worker = {}
+
+def init_worker(populations, config_fn, out_dir):
+    _worker['shared'] = populations
+    _worker['populations'] = populations.frames()
+    _worker['config_fn'] = config_fn
+    _worker['out_dir'] = out_dir
+
+def run_config(config):
+    df = _worker['config_fn'](config, _worker['populations'])
+    write_part(os.path.join(_worker['out_dir'], f"part_{config_key(config)}.csv.gz"), df)
+    return len(df)
+
+def run_sweep(config_fn, configs, populations, out_dir, n_jobs=None, columns=('collateral', 'debt')):
+    '''
+    Run `config_fn` for every config of a parameter grid on a process pool.
+
+    The populations are put in shared memory once. Each finished config is written to
+    `out_dir` as its own part file, and configs whose part already exists are
+    skipped, so an interrupted sweep picks up where it stopped when relaunched. Parts
+    are keyed by config only, use a new `out_dir` when anything else changes.
+    Throughput is printed as configs complete.
+
+    Parameters
+    ----------
+    config_fn : function
+        config_fn(config, populations) -> pd.DataFrame with one row per sim. It is
+        passed to the workers by fork, so it can be defined in a notebook.
+    configs : list[dict]
+        Parameter grid, ie. [{'v2_liq_debt': 0.1, 'v3_liq_debt': 0.05, 'initial_surplus_pct': 0.005}]
+    populations : list[pd.DataFrame]
+        SAFE populations, only `columns` are shared with the workers
+    out_dir : str
+        Directory of the part files
+    n_jobs : int
+        Number of worker processes, defaults to the number of cores
+    Returns
+    -------
+    pd.DataFrame
+        Results of all configs
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    pending = [c for c in configs
+               if not os.path.exists(os.path.join(out_dir, f"part_{config_key(c)}.csv.gz"))]
+    print(f"{len(configs) - len(pending)} of {len(configs)} configs already done")
+
+    if pending:
+        shared = SharedPopulations(populations, columns)
+        ctx = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        start = time.time()
+        n_sims = 0
+        try:
+            with ctx.Pool(n_jobs, initializer=init_worker, initargs=(shared, config_fn, out_dir)) as pool:
+                for i, n in enumerate(pool.imap_unordered(run_config, pending)):
+                    n_sims += n
+                    elapsed = time.time() - start
+                    print(f"{i + 1}/{len(pending)} configs, {n_sims} sims, {n_sims / elapsed:.0f} sims/sec")
+        finally:
+            shared.close()
+
+    return load_sweep(out_dir, configs)
+
+def load_sweep(out_dir, configs=None):
+    '''
+    Returns the results in `out_dir`, only of `configs` if given
+    '''
+    if configs is None:
+        files = sorted(f for f in os.listdir(out_dir) if f.startswith('part_') and f.endswith('.csv.gz'))
+    else:
+        files = [f"part_{config_key(c)}.csv.gz" for c in configs]
+        files = [f for f in files if os.path.exists(os.path.join(out_dir, f))]
+
+    if not files:
+        return pd.DataFrame()
+    return pd.concat([pd.read_csv(os.path.join(out_dir, f)) for f in files], ignore_index=True)
@@ -1,6 +1,10 @@
+import functools
+import numpy as np
+
 def get_input_price(dx, x_balance, y_balance, trade_fee=0.003):
     '''
     How much y received for selling dx?
+    All arguments can be numpy arrays.
     Example:
     new_x = (1 + alpha)*x_balance
     new_y = y_balance - dy
@@ -20,6 +24,7 @@ def get_input_price(dx, x_balance, y_balance, trade_fee=0.003):
 def get_output_price(dy, x_balance, y_balance, trade_fee=0.003):
     '''
     How much x needs to be sold to buy dy?
+    All arguments can be numpy arrays.
     Example:
     new_x = x_balance + dx
     new_y = (1 - beta)*y_balance
@@ -39,8 +44,222 @@ def get_output_price(dy, x_balance, y_balance, trade_fee=0.003):
 def buy_to_price(eth_balance, rai_balance, goal_price, market_price):
     '''
     How much RAI to buy to achieve a goal market price?
+    All arguments can be numpy arrays.
     '''
     a = rai_balance * ((market_price/goal_price)**(1/2) - 1)
 
     # if a is positive, we're already past our goal price
-    return max(-a,0)
+    return np.maximum(-a, 0)
+
+def bisect(f, target, lo, hi, iters=64):
+    '''
+    Elementwise x in [lo, hi] where increasing f(x) reaches `target`, for arrays of targets
+    '''
+    lo, hi, target = [np.array(x, dtype=float) for x in np.broadcast_arrays(lo, hi, target)]
+    for _ in range(iters):
+        mid = (lo + hi) / 2
+        below = f(mid) < target
+        lo = np.where(below, mid, lo)
+        hi = np.where(below, hi, mid)
+
+    return (lo + hi) / 2
+
+class V2Pool():
+    '''
+    Constant product USD/RAI pool. Balances can be arrays, one pool per scenario.
+    '''
+    def __init__(self, usd_balance, rai_balance, trade_fee=0.003):
+        self.usd_balance = np.asarray(usd_balance, dtype=float)
+        self.rai_balance = np.asarray(rai_balance, dtype=float)
+        self.trade_fee = trade_fee
+
+    def price(self):
+        return self.usd_balance / self.rai_balance
+
+    def buy(self, rai_out):
+        '''
+        USD paid for `rai_out`, inf past the pool balance
+        '''
+        rai_out = np.asarray(rai_out, dtype=float)
+        with np.errstate(divide='ignore'):
+            usd_in, _ = get_output_price(rai_out, self.usd_balance, self.rai_balance, self.trade_fee)
+        return np.where(rai_out < self.rai_balance, usd_in, np.inf)
+
+    def buy_to_price(self, price):
+        '''
+        Returns (rai_out, usd_in) of buying until the marginal cost, fee included, is `price`
+        '''
+        gamma = 1 - self.trade_fee
+        k = self.usd_balance * self.rai_balance
+        rai_out = np.maximum(self.rai_balance - np.sqrt(k / (gamma * np.asarray(price, dtype=float))), 0)
+        return rai_out, self.buy(rai_out)
+
+class V3Pool():
+    '''
+    Concentrated liquidity USD/RAI pool of positions with `liquidity` between
+    `lower` and `upper` prices, the last axis of the position arrays. `price` can be
+    an array of scenarios.
+
+    A position holds L*(1/sqrt(p) - 1/sqrt(upper)) RAI above the current price p,
+    so buying moves sqrt(p) through each range at a rate set by the summed liquidity
+    of the positions in range.
+    '''
+    def __init__(self, price, lower, upper, liquidity, trade_fee=0.0005):
+        self.sqrt_price = np.sqrt(np.asarray(price, dtype=float))[..., None]
+        self.sqrt_lower = np.sqrt(np.asarray(lower, dtype=float))
+        self.sqrt_upper = np.sqrt(np.asarray(upper, dtype=float))
+        self.liquidity = np.asarray(liquidity, dtype=float)
+        self.trade_fee = trade_fee
+
+    @classmethod
+    def from_rai_balance(cls, rai_balance, price, lower, upper, trade_fee=0.0005):
+        '''
+        One position in [lower, upper] holding `rai_balance` RAI above `price`
+        '''
+        liquidity = np.asarray(rai_balance, dtype=float) / (1 / np.sqrt(price) - 1 / np.sqrt(upper))
+        return cls(price, [lower], [upper], np.asarray(liquidity)[..., None], trade_fee)
+
+    def price(self):
+        return self.sqrt_price[..., 0]**2
+
+    def _swap(self, sqrt_price):
+        # (rai_out, usd_in) of moving the pool to `sqrt_price`
+        lo = np.clip(self.sqrt_price, self.sqrt_lower, self.sqrt_upper)
+        hi = np.clip(np.asarray(sqrt_price)[..., None], lo, self.sqrt_upper)
+        rai_out = (self.liquidity * (1 / lo - 1 / hi)).sum(axis=-1)
+        usd_in = (self.liquidity * (hi - lo)).sum(axis=-1) / (1 - self.trade_fee)
+        return rai_out, usd_in
+
+    def rai_available(self):
+        return self._swap(np.inf)[0]
+
+    def buy(self, rai_out):
+        '''
+        USD paid for `rai_out`, inf past the RAI held in range
+        '''
+        rai_out = np.asarray(rai_out, dtype=float)
+        available = self.rai_available()
+        sqrt_price = bisect(lambda s: self._swap(s)[0], np.minimum(rai_out, available),
+                            self.sqrt_price[..., 0], self.sqrt_upper.max(axis=-1))
+        return np.where(rai_out <= available, self._swap(sqrt_price)[1], np.inf)
+
+    def buy_to_price(self, price):
+        '''
+        Returns (rai_out, usd_in) of buying until the marginal cost, fee included, is `price`
+        '''
+        return self._swap(np.sqrt(np.asarray(price, dtype=float) * (1 - self.trade_fee)))
+
+class StableSwapPool():
+    '''
+    Curve stableswap USD/RAI pool with amplification `A`. RAI is valued at `rate` USD,
+    ie. the redemption price, as in the RAI metapool. Balances can be arrays.
+    '''
+    def __init__(self, usd_balance, rai_balance, A, trade_fee=0.0004, rate=1.):
+        self.usd_balance = np.asarray(usd_balance, dtype=float)
+        self.rai_balance = np.asarray(rai_balance, dtype=float)
+        self.ann = 4 * A
+        self.trade_fee = trade_fee
+        self.rate = rate
+        self.D = self._invariant(self.usd_balance, self.rai_balance * rate)
+
+    def _invariant(self, x0, x1, iters=255):
+        s = x0 + x1
+        D = s
+        for _ in range(iters):
+            d_p = D**3 / (4 * x0 * x1)
+            D_prev = D
+            D = (self.ann * s + 2 * d_p) * D / ((self.ann - 1) * D + 3 * d_p)
+            if np.all(np.abs(D - D_prev) <= 1e-15 * D):
+                break
+        return D
+
+    def _usd_balance(self, x1):
+        # USD balance keeping the invariant at scaled RAI balance `x1`. Curve's get_y
+        # iterates on y^2 + (b - D)y = c, with two coins it is a quadratic solved directly
+        c = self.D**3 / (4 * x1 * self.ann)
+        q = x1 + self.D / self.ann - self.D
+        root = np.sqrt(q * q + 4 * c)
+        # pick the form without cancellation
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(q > 0, 2 * c / (q + root), (root - q) / 2)
+
+    def _price(self, x0, x1):
+        # marginal USD per RAI, ratio of the invariant's partial derivatives
+        d3 = self.D**3
+        return (self.ann + d3 / (4 * x0 * x1 * x1)) / (self.ann + d3 / (4 * x0 * x0 * x1)) * self.rate
+
+    def price(self):
+        return self._price(self.usd_balance, self.rai_balance * self.rate)
+
+    def buy(self, rai_out):
+        '''
+        USD paid for `rai_out`, inf past the pool balance
+        '''
+        rai_out = np.asarray(rai_out, dtype=float)
+        x1 = (self.rai_balance - np.minimum(rai_out, self.rai_balance)) * self.rate
+        with np.errstate(divide='ignore', invalid='ignore'):
+            usd_in = (self._usd_balance(x1) - self.usd_balance) / (1 - self.trade_fee)
+        return np.where(rai_out < self.rai_balance, usd_in, np.inf)
+
+    def buy_to_price(self, price):
+        '''
+        Returns (rai_out, usd_in) of buying until the marginal cost, fee included, is `price`
+        '''
+        gamma = 1 - self.trade_fee
+
+        def marginal_cost(rai_out):
+            x1 = (self.rai_balance - rai_out) * self.rate
+            return self._price(self._usd_balance(x1), x1) / gamma
+
+        price = np.asarray(price, dtype=float)
+        rai_out = bisect(marginal_cost, price, 0, self.rai_balance * (1 - 1e-12))
+        rai_out = np.where(self.price() / gamma < price, rai_out, 0)
+        return rai_out, self.buy(rai_out)
+
+def route_buy(pools, rai_amount, max_price=np.inf, iters=64):
+    '''
+    Buy `rai_amount` across `pools` at the lowest total cost.
+
+    Cost is lowest when every pool is bought down to the same marginal cost, so the
+    common marginal cost is found by bisection on the total RAI each pool sells up
+    to it. With `max_price`, buying stops at that marginal cost, ie. the highest price
+    an auction keeper can pay for RAI and still profit on discounted collateral.
+    Amounts and pool balances can be arrays of scenarios.
+
+    Parameters
+    ----------
+    pools : list
+        V2Pool, V3Pool and StableSwapPool
+    rai_amount : array-like
+        RAI to buy
+    max_price : array-like
+        Highest marginal cost to pay
+    Returns
+    -------
+    tuple
+        (rai_bought, usd_spent, price): RAI bought from each pool stacked on the first
+        axis, total USD spent and the final marginal cost
+    '''
+    rai_amount = np.asarray(rai_amount, dtype=float)
+    # pools can have balances of different shapes, combined with broadcasting
+    lo = functools.reduce(np.minimum, [p.price() / (1 - p.trade_fee) for p in pools])
+
+    def total(price):
+        return sum(p.buy_to_price(price)[0] for p in pools)
+
+    # double an upper price until it covers the amount, all pools run dry or `max_price`
+    hi = np.minimum(lo * 2, max_price)
+    for _ in range(iters):
+        short = (total(hi) < rai_amount) & (hi < max_price)
+        if not short.any():
+            break
+        hi = np.where(short, np.minimum(hi * 2, max_price), hi)
+
+    log_price = bisect(lambda x: total(np.exp(x)), np.minimum(rai_amount, total(hi)),
+                       np.log(lo), np.log(np.maximum(hi, lo)), iters)
+    price = np.exp(log_price)
+
+    bought = [p.buy_to_price(price) for p in pools]
+    rai_bought = np.stack(np.broadcast_arrays(*[b[0] for b in bought]))
+    usd_spent = sum(b[1] for b in bought)
+    return rai_bought, usd_spent, price
@@ -0,0 +1 @@
+../common/async_mp.py
\ No newline at end of file
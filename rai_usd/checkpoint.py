@@ -0,0 +1 @@
+../common/checkpoint.py
\ No newline at end of file
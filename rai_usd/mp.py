@@ -1,21 +1,34 @@
+import json
+import time
+import requests
+from eth_abi import encode, decode
+from eth_utils import function_abi_to_4byte_selector
 from web3 import Web3, HTTPProvider
 from retry import retry
 from multiprocessing import Queue, Process
 
+from cache import FINALITY_DEPTH
+from rpc_pool import RPCPool, provider
+from metrics import METRICS, count_rpc
+
+# Multicall3 is deployed at the same address on every chain
+MULTICALL3 = "0xcA11bde05977b3631167028862bE2a173976CA11"
+MULTICALL3_FIRST_BLOCK = 14353601
+
 @retry(exceptions=Exception, tries=-1, delay=1, max_delay=None, backoff=1, jitter=0)
 def fetch_link_mp(contract, abi, eth_rpc_url, block_numbers, q):
     """
 
     Parameters
     ----------
-    eth_rpc_url : str
-        ethereum rpc url
+    eth_rpc_url : str or rpc_pool.RPCPool
+        ethereum rpc url, or a pool of them
     block_numbers : iterable[int]
         Block numbers to fetch base_fee for
     q : multiprocessing.Queue
         Queue to put results on
     """
-    w3 = Web3(Web3.HTTPProvider(eth_rpc_url, request_kwargs={"timeout": 10}))
+    w3 = Web3(provider(eth_rpc_url))
     link = w3.eth.contract(address=contract, abi=abi)
     results = []
 
@@ -24,6 +37,7 @@ def fetch_link_mp(contract, abi, eth_rpc_url, block_numbers, q):
             round_id, price, started_at, timestamp, answer_in_round = link.caller(block_identifier=n).latestRoundData()
         except Exception as e:
             print(e)
+            METRICS.skip(n, e, 'fetch_link_mp')
             continue
 
         results.append((n, price, timestamp, started_at))
@@ -36,14 +50,14 @@ def fetch_rp(contract, abi, eth_rpc_url, block_numbers, q):
 
     Parameters
     ----------
-    eth_rpc_url : str
-        ethereum rpc url
+    eth_rpc_url : str or rpc_pool.RPCPool
+        ethereum rpc url, or a pool of them
     block_numbers : iterable[int]
         Block numbers to fetch base_fee for
     q : multiprocessing.Queue
         Queue to put results on
     """
-    w3 = Web3(Web3.HTTPProvider(eth_rpc_url, request_kwargs={"timeout": 10}))
+    w3 = Web3(provider(eth_rpc_url))
     oracle_relayer = w3.eth.contract(address=contract, abi=abi)
     results = []
 
@@ -52,50 +66,286 @@ def fetch_rp(contract, abi, eth_rpc_url, block_numbers, q):
             rp = oracle_relayer.caller(block_identifier=n).redemptionPrice()
         except Exception as e:
             print(e)
+            METRICS.skip(n, e, 'fetch_rp')
             continue
 
         results.append((n, rp))
 
     q.put(results)
-  
+
+# Contract functions each worker calls per block and how it builds its result tuple
+# from the decoded outputs, in call order. Used by the batched fetch mode.
+BATCH_CALLS = {
+    fetch_link_mp: (['latestRoundData'],
+                    lambda n, r: (n, r[0][1], r[0][3], r[0][2])),
+    fetch_rp: (['redemptionPrice'],
+               lambda n, r: (n, r[0][0])),
+}
+
+def encode_calls(abi, fn_names):
+    """
+    Returns (calldata, output_types) for each of the argument-less functions `fn_names`
+    """
+    fn_abis = {x['name']: x for x in json.loads(abi) if x.get('type') == 'function'}
+    calls = []
+    for name in fn_names:
+        fn_abi = fn_abis[name]
+        calldata = '0x' + function_abi_to_4byte_selector(fn_abi).hex()
+        calls.append((calldata, [o['type'] for o in fn_abi['outputs']]))
+
+    return calls
+
+def multicall_data(contract, calls):
+    # Multicall3.aggregate3((address target, bool allowFailure, bytes callData)[])
+    selector = function_abi_to_4byte_selector({'name': 'aggregate3', 'type': 'function',
+                                               'inputs': [{'type': '(address,bool,bytes)[]'}]})
+    args = [(contract, True, bytes.fromhex(calldata[2:])) for calldata, _ in calls]
+
+    return '0x' + (selector + encode(['(address,bool,bytes)[]'], [args])).hex()
+
+def post_batch(session, eth_rpc_url, payload, timeout=10):
+    """
+    Send a JSON-RPC batch request and return the responses ordered by id.
+    `eth_rpc_url` can be an `RPCPool`, which routes the request itself.
+    """
+    if isinstance(eth_rpc_url, RPCPool):
+        responses = eth_rpc_url.post(payload)
+    else:
+        count_rpc(payload)
+        data = json.dumps(payload)
+        with METRICS.timer('rpc_seconds', method='batch'):
+            r = session.post(eth_rpc_url, data=data, headers={'Content-Type': 'application/json'}, timeout=timeout)
+            r.raise_for_status()
+        METRICS.transfer(len(data), len(r.content))
+        responses = r.json()
+    if isinstance(responses, dict):
+        # some providers answer a rejected batch with a single error object
+        raise ValueError(f"batch request failed: {responses.get('error')}")
+
+    return sorted(responses, key=lambda x: x['id'])
+
+def build_batch(contract, calls, block_numbers, multicall=True):
+    """
+    Build a JSON-RPC batch payload with `calls` at each block of `block_numbers`.
+    Returns the payload and the request ids belonging to each block.
+    """
+    payload = []
+    block_ids = []
+    for n in block_numbers:
+        if multicall and len(calls) > 1 and n >= MULTICALL3_FIRST_BLOCK:
+            datas = [(MULTICALL3, multicall_data(contract, calls))]
+        else:
+            datas = [(contract, calldata) for calldata, _ in calls]
+        ids = []
+        for to, data in datas:
+            ids.append(len(payload))
+            payload.append({'jsonrpc': '2.0', 'id': len(payload), 'method': 'eth_call',
+                            'params': [{'to': to, 'data': data}, hex(n)]})
+        block_ids.append((n, ids))
+
+    return payload, block_ids
+
+def call_failed(items):
+    # the calls ran and one failed, ie. reverted or returned nothing before the
+    # contract was deployed, unlike node errors such as rate limits or missing state
+    return all('result' in x or 'revert' in str((x.get('error') or {}).get('message', '')).lower() for x in items)
+
+def decode_batch(calls, build_row, block_ids, responses, contract=None, cache=None):
+    """
+    Decode batch `responses` into result tuples, skipping blocks with a failed call.
+    Return data of the decoded blocks, and the blocks whose calls failed, are stored
+    in `cache` if given.
+    """
+    results = []
+    raw = []
+    failed = []
+    for n, ids in block_ids:
+        try:
+            outputs = [responses[j]['result'] for j in ids]
+            if len(ids) < len(calls):
+                (outputs,) = decode(['(bool,bytes)[]'], bytes.fromhex(outputs[0][2:]))
+                if not all(success for success, _ in outputs):
+                    raise ValueError(f"multicall failed at block {n}")
+                outputs = [data for _, data in outputs]
+            else:
+                outputs = [bytes.fromhex(x[2:]) for x in outputs]
+            decoded = [decode(types, data) for (_, types), data in zip(calls, outputs)]
+        except Exception as e:
+            print(e, [responses[j].get('error') for j in ids])
+            METRICS.skip(n, e, 'decode_batch')
+            if call_failed([responses[j] for j in ids]):
+                failed.append((n, e))
+            continue
+
+        results.append(build_row(n, decoded))
+        raw.append((n, outputs))
+
+    if cache:
+        for i, (calldata, _) in enumerate(calls):
+            cache.put(contract, calldata, [(n, outputs[i]) for n, outputs in raw])
+            cache.put_failed(contract, calldata, failed)
+
+    return results
+
+def cached_results(cache, f, contract, abi, block_numbers):
+    """
+    Returns results of worker `f` for blocks fully present in `cache` and the blocks
+    that still need to be fetched. Blocks whose calls are cached as failed are in
+    neither.
+    """
+    fn_names, build_row = BATCH_CALLS[f]
+    calls = encode_calls(abi, fn_names)
+    hits = [cache.get(contract, calldata, block_numbers) for calldata, _ in calls]
+    failed = [cache.failed(contract, calldata, block_numbers) for calldata, _ in calls]
+
+    results = []
+    missing = []
+    for n in block_numbers:
+        if any(n in x for x in failed):
+            continue
+        if all(n in h for h in hits):
+            results.append(build_row(n, [decode(types, h[n]) for (_, types), h in zip(calls, hits)]))
+        else:
+            missing.append(n)
+
+    return results, missing
+
+def fetch_batch(f, contract, abi, eth_rpc_url, block_numbers, batch_size=100, multicall=True, session=None,
+                cache=None):
+    """
+    Fetch the same results as worker `f` using JSON-RPC batch requests.
+
+    Every request carries the calls for up to `batch_size` blocks. With `multicall`,
+    the calls of one block are packed into a single Multicall3 `aggregate3` call for
+    blocks after Multicall3 was deployed.
+
+    Parameters
+    ----------
+    f : function
+        worker function in `BATCH_CALLS`, ie. fetch_rp
+    eth_rpc_url : str or rpc_pool.RPCPool
+        ethereum rpc url, or a pool of them
+    block_numbers : iterable[int]
+        Block numbers to fetch
+    batch_size : int
+        Number of blocks per JSON-RPC batch request
+    multicall : bool
+        Use Multicall3 to pack per-block calls into one eth_call
+    session : requests.Session
+        Session to reuse, a new one is created if None
+    cache : cache.CallCache
+        Cache to store fetched return data in
+    Returns
+    -------
+    list[tuple]
+        Results in the same format `f` puts on its queue
+    """
+    fn_names, build_row = BATCH_CALLS[f]
+    calls = encode_calls(abi, fn_names)
+    session = session or requests.Session()
+    block_numbers = list(block_numbers)
+    results = []
+
+    for i in range(0, len(block_numbers), batch_size):
+        payload, block_ids = build_batch(contract, calls, block_numbers[i:i + batch_size], multicall)
+        responses = post_batch(session, eth_rpc_url, payload)
+        results.extend(decode_batch(calls, build_row, block_ids, responses, contract, cache))
+
+    return results
+
+def fetch_batch_mp(f, contract, abi, eth_rpc_url, block_numbers, q, batch_size=100, multicall=True, cache=None):
+    q.put(fetch_batch(f, contract, abi, eth_rpc_url, block_numbers, batch_size, multicall, cache=cache))
+
 def split(a, n):
     k, m = divmod(len(a), n)
     return (a[i*k+min(i, m):(i+1)*k+min(i+1, m)] for i in range(n))
 
-def build_procs(f, q, blocks, n_jobs, contract, abi, eth_rpc_url):
+def run_metered(target, args, mq):
+    # run a worker in its own process and send its metrics back on `mq`
+    METRICS.reset()
+    try:
+        target(*args)
+    finally:
+        mq.put(METRICS.snapshot())
+
+def build_procs(f, q, blocks, n_jobs, contract, abi, eth_rpc_url, batch_size=None, cache=None, mq=None):
     procs = []
 
     chunks = split(blocks, n_jobs)
     for chunk in chunks:
-        p = Process(target=f, args=(contract, abi, eth_rpc_url, chunk, q))
+        if batch_size:
+            target, args = fetch_batch_mp, (f, contract, abi, eth_rpc_url, chunk, q, batch_size, True, cache)
+        else:
+            target, args = f, (contract, abi, eth_rpc_url, chunk, q)
+        p = Process(target=run_metered, args=(target, args, mq)) if mq else Process(target=target, args=args)
         procs.append(p)
 
     return procs
 
-def fetch(f, n_jobs, contract, abi, eth_rpc_url, start_block=None, stop_block=None, blocks=None):
+def fetch(f, n_jobs, contract, abi, eth_rpc_url, start_block=None, stop_block=None, blocks=None, batch_size=None,
+          engine='process', on_result=None, cache=None):
+    """
+    Run worker `f` over `blocks`.
+
+    With engine='process', `f` runs in `n_jobs` processes. If `batch_size` is set, each
+    process fetches `batch_size` blocks per JSON-RPC batch request.
+
+    With engine='async', batches of `batch_size` blocks (default 100) are fetched from a
+    single process with up to `n_jobs` requests in flight. Concurrency adapts to provider
+    latency and rate limiting, and `on_result` is called with each batch as it completes.
+    An `RPCPool` as `eth_rpc_url` is used from a thread per in-flight request.
+
+    If `cache` (a cache.CallCache) is given, blocks already in the cache are not fetched and
+    newly fetched finalized blocks are added to it. Fetching always goes through the batched
+    mode then.
+
+    Call counts, latencies, bytes and skipped blocks of every worker process are merged
+    into `metrics.METRICS`, see `METRICS.summary()`.
+    """
     if (blocks and start_block) or (blocks and stop_block) or (not blocks and not start_block):
         raise ValueError("Pass `blocks` or `start_block` and `stop_block`. Not both")
 
     if start_block:
         blocks = list(range(start_block, stop_block +1))
 
-    results = []
-    q = Queue()
-
     n_blocks = len(blocks)
     assert n_blocks > 0
-    chunks = split(blocks, n_jobs)
 
-    procs = build_procs(f, q, blocks, n_jobs, contract, abi, eth_rpc_url)
-    for p in procs:
-        p.start()
+    start = time.time()
+    results = []
+    if cache:
+        results, blocks = cached_results(cache, f, contract, abi, blocks)
+        METRICS.count('cached_blocks_total', n_blocks - len(blocks), worker=f.__name__)
+        if not blocks:
+            return sorted(results, key=lambda x: x[0])
+        w3 = Web3(provider(eth_rpc_url))
+        cache.finalized_block = w3.eth.block_number - FINALITY_DEPTH
+        batch_size = batch_size or 100
+
+    if engine == 'async':
+        from async_mp import fetch_async, run
+        results += run(fetch_async(f, contract, abi, eth_rpc_url, blocks, on_result=on_result,
+                                   batch_size=batch_size or 100, max_concurrency=n_jobs, cache=cache))
+    elif engine != 'process':
+        raise ValueError(f"Unknown engine {engine}")
+    else:
+        q = Queue()
+        mq = Queue()
+
+        procs = build_procs(f, q, blocks, n_jobs, contract, abi, eth_rpc_url, batch_size, cache, mq)
+        for p in procs:
+            p.start()
+
+        for p in procs:
+            proc_results = q.get()
+            for r in proc_results:
+                results.append(r)
 
-    for p in procs:
-        proc_results = q.get()
-        for r in proc_results:
-            results.append(r)
+        for p in procs:
+            METRICS.merge(mq.get())
+            p.join()
 
-    for p in procs:
-        p.join()
+    METRICS.count('blocks_total', len(blocks), worker=f.__name__)
+    METRICS.observe('fetch_seconds', time.time() - start, worker=f.__name__)
 
     return sorted(results, key=lambda x: x[0])
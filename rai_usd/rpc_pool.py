@@ -0,0 +1 @@
+../common/rpc_pool.py
\ No newline at end of file
@@ -0,0 +1 @@
+../common/align.py
\ No newline at end of file
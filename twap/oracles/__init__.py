@@ -0,0 +1,2 @@
+from .ring import RingTWAP, UniswapMedianizer, ChainlinkTWAP
+from .grid import grid_twap, grid_frame
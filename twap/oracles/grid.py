@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+def to_seconds(times):
+    # event times as float seconds, from numbers or datetimes
+    if isinstance(times, (pd.Series, pd.Index)) and pd.api.types.is_datetime64_any_dtype(times):
+        return (pd.DatetimeIndex(times).as_unit('ns').asi8 / 1e9)
+    return np.asarray(times, dtype=float)
+
+def update_indices(times, period_sizes):
+    '''
+    Indices of the events where each period size records a slot, walking all
+    settings at once: (n_updates, n_settings) with -1 after a setting's last update
+    '''
+    n = len(times)
+    idx = np.zeros(len(period_sizes), dtype=int)
+    rows = [idx]
+    while True:
+        # first event at least one period after the last slot
+        nxt = np.searchsorted(times, times[np.maximum(idx, 0)] + period_sizes, side='left')
+        idx = np.where((idx >= 0) & (nxt < n), nxt, -1)
+        if (idx < 0).all():
+            break
+        rows.append(idx)
+
+    return np.stack(rows)
+
+def grid_twap(times, prices, settings, kind='uniswap'):
+    '''
+    Evaluate a grid of TWAP settings in one pass over the data.
+
+    Gives the results of `UniswapMedianizer` or `ChainlinkTWAP` fed every event with
+    `update`, for every (window_size, granularity) at once. The price cumulative is
+    one cumsum over the events, the update times of all settings are stepped
+    together with searchsorted, and each result is a difference of cumulatives
+    `granularity` slots apart.
+
+    Parameters
+    ----------
+    times : array-like
+        Sorted event times, seconds or datetimes
+    prices : array-like
+        Price at each event
+    settings : list[tuple]
+        (window_size, granularity), window in seconds, ie. [(16*3600, 4), (40*3600, 5)]
+    kind : str
+        'uniswap' integrates the spot price, 'chainlink' weights the price read at
+        each update
+    Returns
+    -------
+    dict
+        (window_size, granularity) -> pd.Series of results indexed by update time,
+        starting at the first update with a full ring
+    '''
+    index = pd.Index(times) if isinstance(times, (pd.Series, pd.Index)) else None
+    t = to_seconds(times)
+    prices = np.asarray(prices, dtype=float)
+    windows = np.array([s[0] for s in settings], dtype=float)
+    granularities = np.array([s[1] for s in settings], dtype=int)
+
+    if kind == 'uniswap':
+        # integral of the price held since the previous event
+        cumulative = np.concatenate([[0.], np.cumsum(prices[:-1] * np.diff(t))])
+    elif kind != 'chainlink':
+        raise ValueError(f"unknown TWAP kind {kind}")
+
+    # settings with the same period update at the same events
+    periods, setting_period = np.unique(windows / granularities, return_inverse=True)
+    updates = update_indices(t, periods)
+
+    results = {}
+    for j, (window_size, granularity) in enumerate(settings):
+        idx = updates[:, setting_period[j]]
+        idx = idx[idx >= 0]
+        update_times = t[idx]
+        if kind == 'uniswap':
+            slots = cumulative[idx]
+        else:
+            slots = np.concatenate([[0.], np.cumsum(prices[idx[1:]] * np.diff(update_times))])
+
+        values = (slots[granularity:] - slots[:-granularity]) / (update_times[granularity:] - update_times[:-granularity])
+        at = index[idx[granularity:]] if index is not None else update_times[granularity:]
+        results[(window_size, granularity)] = pd.Series(values, index=at)
+
+    return results
+
+def grid_frame(results, index, prefix='twap'):
+    '''
+    Results of `grid_twap` forward filled onto `index`, one column per setting,
+    ie. the 1 minute index of the TWAP notebooks
+    '''
+    return pd.DataFrame({f"{prefix}_{w:g}_{g}": s.reindex(index, method='ffill')
+                         for (w, g), s in results.items()}, index=index)
@@ -0,0 +1,77 @@
+import math
+
+class RingTWAP():
+    '''
+    TWAP over the last `granularity` periods of `window_size / granularity` seconds,
+    kept in a ring buffer of granularity + 1 slots.
+
+    `update(t, price)` is a keeper call at time `t` seeing `price`. It records a slot
+    when at least one period passed since the last one, as `updateResult` on chain,
+    and costs O(1) whatever the window. The result is nan until the ring is full.
+    Subclasses define what a slot accumulates.
+    '''
+    def __init__(self, window_size, granularity):
+        self.window_size = window_size
+        self.granularity = granularity
+        self.period_size = window_size / granularity
+
+        self.times = [math.nan] * (granularity + 1)
+        self.cumulatives = [math.nan] * (granularity + 1)
+        self.n_updates = 0
+        self.cumulative = 0.
+        self.result = math.nan
+
+    def last_update_time(self):
+        if self.n_updates == 0:
+            return None
+        return self.times[(self.n_updates - 1) % (self.granularity + 1)]
+
+    def update(self, t, price):
+        '''
+        Returns the result after a keeper call at `t` with the current `price`
+        '''
+        last_time = self.last_update_time()
+        self.observe(t, price, last_time)
+        if last_time is not None and t - last_time < self.period_size:
+            return self.result
+
+        i = self.n_updates % (self.granularity + 1)
+        self.times[i] = t
+        self.cumulatives[i] = self.cumulative
+        self.n_updates += 1
+
+        if self.n_updates > self.granularity:
+            # the slot after the newest is the oldest once the ring is full
+            first = self.n_updates % (self.granularity + 1)
+            self.result = (self.cumulative - self.cumulatives[first]) / (t - self.times[first])
+
+        return self.result
+
+class UniswapMedianizer(RingTWAP):
+    '''
+    Uniswap consecutive slots medianizer: time weighted average of the spot price
+    over the window, from the price cumulative of the pair.
+
+    Every price is an event, the cumulative integrates the price held since the
+    previous event, so feed it all swaps/syncs and not only keeper calls.
+    '''
+    def __init__(self, window_size, granularity):
+        super().__init__(window_size, granularity)
+        self.last_time = None
+        self.last_price = math.nan
+
+    def observe(self, t, price, last_update_time):
+        if self.last_time is not None:
+            self.cumulative += self.last_price * (t - self.last_time)
+        self.last_time = t
+        self.last_price = price
+
+class ChainlinkTWAP(RingTWAP):
+    '''
+    Chainlink TWAP: the aggregator answer read at each update, weighted by the time
+    since the previous update. Prices between updates are ignored, as on chain, which
+    is also how the medianizer accumulates its ETH/USD converter price.
+    '''
+    def observe(self, t, price, last_update_time):
+        if last_update_time is not None and t - last_update_time >= self.period_size:
+            self.cumulative += price * (t - last_update_time)